@@ -0,0 +1,165 @@
+# This file is subject to the terms and conditions defined in LICENSE.
+# (c) 2011-2013, ReportGrid Inc. All rights reserved.
+
+# Benchmarks for the Precog client, run against the local FakePrecog server
+# (see precog/test/fakeserver.py) so no Precog account is needed.
+#
+#   python bench.py --output before.json
+#   ... change the client ...
+#   python bench.py --output after.json --compare before.json
+#
+# Use --latency and --bandwidth to model a remote server.
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+from precog import *
+from precog.test.fakeserver import FakePrecog
+
+def timed(fn, repeat):
+    """Run fn() repeat times and return the best time in seconds."""
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        fn()
+        t = time.time() - t0
+        best = t if best is None else min(best, t)
+    return best
+
+def events(n):
+    return [{"i": i, "name": "event %d" % i, "value": i * 0.5, "ok": i % 2 == 0} for i in range(n)]
+
+def payload(format, objs):
+    if format == 'json':
+        return json.dumps(objs)
+    if format == 'jsonstream':
+        return "".join(json.dumps(o) + "\n" for o in objs)
+    lines = ["i,name,value,ok"] + ["%(i)d,%(name)s,%(value)s,%(ok)s" % o for o in objs]
+    return "\n".join(lines) + "\n"
+
+FORMATS = {'json': Format.json, 'jsonstream': Format.jsonstream, 'csv': Format.csv}
+
+def bench_ingest(server, client, args):
+    """Ingest throughput by batch size and format."""
+    out = []
+    for format in ('json', 'jsonstream', 'csv'):
+        for batch in args.batches:
+            objs = events(batch)
+            data = payload(format, objs)
+            calls = max(1, args.events // batch)
+            def run():
+                for i in range(calls):
+                    if format == 'json':
+                        client.append_all('bench/ingest', objs)
+                    else:
+                        client.append_all_from_string('bench/ingest', FORMATS[format], data)
+            t = timed(run, args.repeat)
+            out.append({'name': 'ingest/%s/%d' % (format, batch), 'seconds': t,
+                        'events_per_sec': calls * batch / t,
+                        'bytes_per_sec': calls * len(data) / t})
+            client.delete('bench/ingest')
+    return out
+
+def bench_query(server, client, args):
+    """Query latency, and how it scales with the size of the result."""
+    out = []
+    for size in args.sizes:
+        path = 'bench/query%d' % size
+        client.delete(path)
+        client.append_all(path, events(size))
+        for kind, fn in (('query', lambda: client.query('//%s' % path)),
+                         ('query_iter', lambda: list(client.query_iter('//%s' % path))),
+                         ('count', lambda: client.query('count(//%s)' % path))):
+            t = timed(fn, args.repeat)
+            out.append({'name': '%s/%d' % (kind, size), 'seconds': t, 'rows_per_sec': size / t})
+        client.delete(path)
+    return out
+
+def bench_connections(server, client, args):
+    """Per-request cost with pooled keep-alive connections and without."""
+    out = []
+    for name, pool in (('pooled', ConnectionPool()), ('unpooled', ConnectionPool(size=0))):
+        c = Precog(server.apikey, server.accountid, host=server.host, port=server.port,
+                   https=False, pool=pool)
+        n = args.requests
+        def run():
+            for i in range(n):
+                c.query('count(//nonexistent)')
+        t = timed(run, args.repeat)
+        pool.clear()
+        out.append({'name': 'connections/%s' % name, 'seconds': t, 'ms_per_request': 1000.0 * t / n})
+    return out
+
+def bench_codecs(server, client, args):
+    """Encoding and decoding time with each installed JSON library."""
+    out = []
+    objs = events(args.events)
+    text = json.dumps(objs)
+    for name in ('auto', 'json', 'simplejson', 'ujson'):
+        try:
+            codec = JsonCodec(None if name == 'auto' else name)
+        except PrecogClientError:
+            continue
+        for kind, fn in (('dumps', lambda: codec.dumps(objs)), ('loads', lambda: codec.loads(text))):
+            t = timed(fn, args.repeat)
+            out.append({'name': 'codec/%s/%s' % (name, kind), 'seconds': t,
+                        'events_per_sec': len(objs) / t})
+    return out
+
+BENCHMARKS = [('ingest', bench_ingest), ('query', bench_query), ('connections', bench_connections),
+              ('codecs', bench_codecs)]
+
+def compare(results, path):
+    """Print each result next to the same result from an earlier run."""
+    old = dict((r['name'], r) for r in json.load(open(path))['results'])
+    print "%-32s %12s %12s %8s" % ('benchmark', 'before (s)', 'after (s)', 'speedup')
+    for r in results:
+        o = old.get(r['name'])
+        if o is None: continue
+        print "%-32s %12.4f %12.4f %7.2fx" % (r['name'], o['seconds'], r['seconds'],
+                                             o['seconds'] / r['seconds'] if r['seconds'] else 0)
+
+def main(argv):
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('--latency', type=float, default=0.0, help='server latency in seconds')
+    p.add_argument('--bandwidth', type=int, default=None, help='server bandwidth in bytes/second')
+    p.add_argument('--repeat', type=int, default=3, help='runs per benchmark (the best is kept)')
+    p.add_argument('--events', type=int, default=20000, help='events ingested per run')
+    p.add_argument('--batches', type=int, nargs='+', default=[1, 10, 100, 1000, 10000])
+    p.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 100000])
+    p.add_argument('--requests', type=int, default=200, help='requests per connection benchmark')
+    p.add_argument('--only', nargs='+', choices=[n for n, f in BENCHMARKS], help='benchmarks to run')
+    p.add_argument('--output', help='write results as JSON to this file')
+    p.add_argument('--compare', help='compare with the JSON results of an earlier run')
+    args = p.parse_args(argv)
+
+    server = FakePrecog(latency=args.latency, bandwidth=args.bandwidth).start()
+    client = Precog(server.apikey, server.accountid, host=server.host, port=server.port, https=False)
+    results = []
+    try:
+        for name, fn in BENCHMARKS:
+            if args.only and name not in args.only: continue
+            for r in fn(server, client, args):
+                results.append(r)
+                sys.stderr.write("%-32s %10.4fs\n" % (r['name'], r['seconds']))
+    finally:
+        client.pool.clear()
+        server.stop()
+
+    report = {'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                       'latency': args.latency, 'bandwidth': args.bandwidth,
+                       'repeat': args.repeat, 'time': time.time()},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -4,7 +4,6 @@
 # this is a script that runs some tests on an existing account to make sure
 # everything is working properly.
  
-import time
 from precog import *
 
 host = "devapi.precog.com"
@@ -52,19 +51,8 @@ response = api.query("count(//nonexistent)", "qux", detailed=True)
 assert response == {'serverWarnings': [], 'serverErrors': [], 'errors': [], 'data': [0], 'warnings': []}, response
 print 'detailed empty count: ok'
 
-def queryUntil(bp, q, expected, timeout=30):
-    t0 = time.time()
-    res = None
-    while time.time() - t0 < timeout:
-        print "  trying..."
-        res = api.query(q, bp)
-        if res == expected:
-            return
-        time.sleep(0.5)
-    assert res == expected, res
-
 api.delete("qux/test")
-queryUntil("qux", "count(//test)", [0])
+assert api.wait_until_visible("qux/test", 0)
 print "delete qux/test: ok"
 
 objs = []
@@ -73,7 +61,7 @@ response = api.append_all("qux/test", objs)
 assert response['ingested'] == 100, response
 print "populate qux/test: ok"
 
-queryUntil("qux", "count(//test)", [100])
+assert api.wait_until_visible("qux/test", 100)
 print "count qux/test: ok"
 
 newer = []
@@ -84,5 +72,5 @@ response = api.upload_string("qux/test", Format.json, s)
 assert response['ingested'] == 60, response
 print "upload new qux/test: ok"
 
-queryUntil("qux", "count(//test)", [60])
+assert api.wait_until_visible("qux/test", 60)
 print "count qux/test again: ok"
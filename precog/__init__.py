@@ -1,14 +1,34 @@
 # This file is subject to the terms and conditions defined in LICENSE.
 # (c) 2011-2013, ReportGrid Inc. All rights reserved.
 
+import bisect
+import collections
+import csv
+import errno
+import fcntl
+import heapq
+import itertools
 import json
 import logging
+import mmap
+import multiprocessing
+import os
 import posixpath
+import Queue
+import random
+import re
+import select
+import socket
+import ssl
+import stat
+import threading
 import time
 import datetime
 import sys
+import zlib
 
-from httplib import HTTPSConnection, HTTPConnection
+from httplib import HTTPSConnection, HTTPConnection, HTTPException
+from multiprocessing.pool import ThreadPool
 from urllib import urlencode, quote_plus, pathname2url
 from base64 import urlsafe_b64encode, urlsafe_b64decode, standard_b64encode
 
@@ -19,6 +39,11 @@ __author_email__ = 'erik@precog.com'
 __description__  = 'Python client library for Precog (http://www.precog.com)'
 __url__          = 'https://github.com/precog/precog_python_client'
 
+log = logging.getLogger(__name__)
+
+# Size of the blocks used when streaming request bodies.
+CHUNK_SIZE = 64 * 1024
+
 def ujoin(p1, p2):
     if not p1: return p2
     if not p2: return p1
@@ -42,8 +67,1294 @@ class PrecogServiceError(Exception):
     """
 Raised on HTTP response errors.
 
-This error may suggest a bug in the client or platform.
+This error may suggest a bug in the client or platform. The HTTP status of
+the response, if any, is available as ``status``.
+    """
+    status = None
+
+class _TimedHTTPConnection(HTTPConnection):
+    """An HTTPConnection which records its connect time and bytes sent."""
+    timings = None
+    sent    = 0
+
+    def connect(self):
+        t0 = time.time()
+        HTTPConnection.connect(self)
+        self.timings = {'connect': time.time() - t0}
+
+    def send(self, data):
+        self.sent += len(data)
+        HTTPConnection.send(self, data)
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    """An HTTPSConnection which records its connect and TLS handshake times."""
+    timings = None
+    sent    = 0
+
+    def connect(self):
+        t0 = time.time()
+        HTTPConnection.connect(self)
+        t1 = time.time()
+        host = self._tunnel_host or self.host
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=host)
+        self.timings = {'connect': t1 - t0, 'tls': time.time() - t1}
+
+    def send(self, data):
+        self.sent += len(data)
+        HTTPConnection.send(self, data)
+
+class ConnectionPool(object):
+    """
+A thread-safe pool of keep-alive HTTP(S) connections.
+
+Idle connections are kept per ``(host, port, https)`` key, so that consecutive
+requests to the same server reuse one TCP connection (and TLS session) instead
+of paying for a new handshake each time. Connections that have been idle for
+too long, or whose socket was closed by the server, are discarded when they are
+borrowed.
+
+A single pool may be shared by many ``Precog`` clients and threads. The
+counters ``hits`` (connection reused) and ``misses`` (new connection opened)
+are available as attributes and through ``stats()``.
+
+Keyword Arguments:
+ * size (int): Maximum number of idle connections kept per key.
+ * idle_timeout (float): Seconds a connection may stay idle before eviction.
+ * timeout (float): Socket timeout for new connections (None means blocking).
+    """
+    def __init__(self, size=8, idle_timeout=30.0, timeout=None):
+        self.size         = size
+        self.idle_timeout = idle_timeout
+        self.timeout      = timeout
+        self.hits         = 0
+        self.misses       = 0
+        self.evictions    = 0
+        self._idle        = {}
+        self._lock        = threading.Lock()
+
+    def create(self, host, port, https):
+        """Open a new (unpooled) connection to the given server."""
+        s = "%s:%s" % (host, port)
+        kw = {} if self.timeout is None else {'timeout': self.timeout}
+        if https:
+            return _TimedHTTPSConnection(s, **kw)
+        else:
+            return _TimedHTTPConnection(s, **kw)
+
+    def get(self, host, port, https):
+        """
+Borrow a connection for ``(host, port, https)``.
+
+Returns a ``(conn, reused)`` tuple, where ``reused`` tells whether the
+connection came from the pool (and so might turn out to be closed by the server
+in the middle of the next request).
+        """
+        key = (host, port, https)
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, t = idle.pop()
+                if now - t > self.idle_timeout or _is_stale(conn):
+                    self.evictions += 1
+                    conn.close()
+                    continue
+                self.hits += 1
+                return conn, True
+            self.misses += 1
+        return self.create(host, port, https), False
+
+    def put(self, host, port, https, conn):
+        """Return a borrowed connection to the pool (or close it if full)."""
+        if conn.sock is None:
+            return
+        key = (host, port, https)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def evict(self):
+        """Close every idle connection which has exceeded ``idle_timeout``."""
+        now = time.time()
+        with self._lock:
+            for key, idle in self._idle.items():
+                keep = []
+                for conn, t in idle:
+                    if now - t > self.idle_timeout or _is_stale(conn):
+                        self.evictions += 1
+                        conn.close()
+                    else:
+                        keep.append((conn, t))
+                self._idle[key] = keep
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._lock:
+            for idle in self._idle.values():
+                for conn, t in idle: conn.close()
+            self._idle = {}
+
+    def stats(self):
+        """Return a dictionary of pool counters."""
+        with self._lock:
+            idle = sum(len(v) for v in self._idle.values())
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'idle': idle}
+
+def _is_stale(conn):
+    """
+An idle keep-alive socket should never be readable: if it is, the server has
+either closed it or sent something we did not ask for.
+    """
+    if conn.sock is None: return True
+    try:
+        r, _, _ = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(r)
+
+default_pool = ConnectionPool()
+
+class _Endpoint(object):
+    """Routing and health state of one ``HostPool`` endpoint."""
+    def __init__(self, key):
+        self.key           = key
+        self.outstanding   = 0
+        self.ewma          = None
+        self.requests      = 0
+        self.errors        = 0
+        self.failures      = 0
+        self.ejections     = 0
+        self.ejected_until = None
+        self.probing       = False
+
+def _parse_endpoint(e):
+    """Turn "host", "host:port", (host, port) or (host, port, https) into a key."""
+    if isinstance(e, basestring):
+        host, _, port = e.partition(':')
+        e = (host, int(port)) if port else (host, 443)
+    if len(e) == 2:
+        e = (e[0], e[1], e[1] != 80)
+    return tuple(e)
+
+class HostPool(object):
+    """
+A set of equivalent Precog endpoints (for instance regional servers and a load
+balancer) which a ``Precog`` client spreads its requests over.
+
+Each request goes to the healthy endpoint with the fewest outstanding requests
+('least_outstanding'), or the lowest latency, measured as an exponentially
+weighted moving average of the time to the response headers and scaled by
+the outstanding requests ('ewma').
+
+An endpoint is ejected after ``max_failures`` consecutive failures (connection
+errors or 5xx responses). Once ``eject_time`` seconds have passed, a single
+trial request is let through: if it succeeds the endpoint is readmitted,
+otherwise it is ejected again for twice as long (up to ``max_eject_time``).
+With ``check_interval`` set, a background thread also opens a TCP connection
+to every endpoint at that interval, which readmits ejected endpoints as soon as
+they accept connections again, and counts against idle endpoints that don't.
+Failed GET requests are retried on another endpoint.
+
+Arguments:
+ * endpoints (list): Endpoints, each a ``(host, port, https)`` tuple, a
+   ``(host, port)`` tuple (HTTPS unless the port is 80), or a "host:port" or
+   "host" string (port 443 over HTTPS).
+
+Keyword Arguments:
+ * strategy (str): 'least_outstanding' or 'ewma'.
+ * max_failures (int): Consecutive failures before an endpoint is ejected.
+ * eject_time (float): Seconds an endpoint is first ejected for.
+ * max_eject_time (float): Maximum seconds an endpoint is ejected for.
+ * decay (float): Weight of each new latency sample in the moving average.
+ * check_interval (float): Seconds between active health checks (defaults to
+   None, no active checks).
+ * check_timeout (float): Seconds before an active check fails.
+    """
+    def __init__(self, endpoints, strategy='least_outstanding', max_failures=3, eject_time=5.0,
+                 max_eject_time=300.0, decay=0.3, check_interval=None, check_timeout=2.0):
+        if strategy not in ('least_outstanding', 'ewma'):
+            raise PrecogClientError("unknown routing strategy %r" % strategy)
+        if not endpoints:
+            raise PrecogClientError("no endpoints given")
+        self.endpoints      = [_Endpoint(_parse_endpoint(e)) for e in endpoints]
+        self.strategy       = strategy
+        self.max_failures   = max_failures
+        self.eject_time     = eject_time
+        self.max_eject_time = max_eject_time
+        self.decay          = decay
+        self.check_interval = check_interval
+        self.check_timeout  = check_timeout
+        self._by_key        = dict((e.key, e) for e in self.endpoints)
+        self._lock          = threading.Lock()
+        self._closed        = threading.Event()
+        if check_interval is not None:
+            t = threading.Thread(target=self._check_loop, name='precog-health')
+            t.daemon = True
+            t.start()
+
+    def acquire(self):
+        """Choose the endpoint for a request; returns its ``(host, port, https)`` key."""
+        now = time.time()
+        with self._lock:
+            live = [e for e in self.endpoints if e.ejected_until is None]
+            trial = [e for e in self.endpoints if e.ejected_until is not None
+                     and e.ejected_until <= now and not e.probing]
+            if trial:
+                e = trial[0]
+                e.probing = True
+            elif live:
+                if self.strategy == 'ewma':
+                    # endpoints without samples yet are assumed to be as fast as the fastest
+                    known = [e.ewma for e in live if e.ewma is not None]
+                    default = min(known) if known else 1.0
+                    score = lambda e: ((default if e.ewma is None else e.ewma) * (e.outstanding + 1),
+                                       random.random())
+                else:
+                    score = lambda e: (e.outstanding, e.ewma or 0, random.random())
+                e = min(live, key=score)
+            else:
+                # everything is ejected: use the endpoint that is due back first
+                e = min(self.endpoints, key=lambda e: e.ejected_until)
+            e.outstanding += 1
+            return e.key
+
+    def release(self, key, latency=None, ok=None):
+        """
+Report the end of a request sent to ``key``: ``ok`` is True if it succeeded,
+False if it failed, or None if the endpoint was not at fault.
+        """
+        with self._lock:
+            e = self._by_key[key]
+            e.outstanding -= 1
+            e.probing = False
+            if ok is None:
+                return
+            e.requests += 1
+            if ok:
+                if latency is not None:
+                    e.ewma = latency if e.ewma is None else \
+                        self.decay * latency + (1 - self.decay) * e.ewma
+                self._succeeded(e)
+            else:
+                e.errors += 1
+                self._failed(e)
+
+    def _succeeded(self, e):
+        e.failures = 0
+        if e.ejected_until is not None:
+            log.info("readmitting %s:%s", e.key[0], e.key[1])
+            e.ejected_until = None
+            e.ejections = 0
+
+    def _failed(self, e):
+        e.failures += 1
+        if e.ejected_until is not None or e.failures >= self.max_failures:
+            t = min(self.eject_time * 2 ** e.ejections, self.max_eject_time)
+            if e.ejected_until is None:
+                log.warning("ejecting %s:%s for %ss", e.key[0], e.key[1], t)
+            e.ejected_until = time.time() + t
+            e.ejections += 1
+
+    def check(self):
+        """Run an active health check of every endpoint now."""
+        for e in self.endpoints:
+            try:
+                socket.create_connection(e.key[:2], self.check_timeout).close()
+                ok = True
+            except (socket.error, socket.timeout):
+                ok = False
+            with self._lock:
+                if ok:
+                    self._succeeded(e)
+                elif e.ejected_until is None and e.outstanding == 0:
+                    self._failed(e)
+
+    def _check_loop(self):
+        while not self._closed.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception:
+                log.exception("health check failed")
+
+    def close(self):
+        """Stop active health checks."""
+        self._closed.set()
+
+    def stats(self):
+        """Return a list with the counters and state of each endpoint."""
+        with self._lock:
+            return [{'host': e.key[0], 'port': e.key[1], 'https': e.key[2],
+                     'outstanding': e.outstanding, 'ewma': e.ewma, 'requests': e.requests,
+                     'errors': e.errors, 'ejected': e.ejected_until is not None}
+                    for e in self.endpoints]
+
+def _body_length(body):
+    """
+Return the number of bytes a request body will send, or None when the length
+is unknown and the body must be sent with chunked transfer encoding.
+    """
+    if isinstance(body, basestring):
+        return len(body)
+    try:
+        st = os.fstat(body.fileno())
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return st.st_size - body.tell()
+
+def _iter_chunks(body):
+    """Yield the non-empty blocks of a file-like object or iterable of strings."""
+    if hasattr(body, 'read'):
+        while True:
+            chunk = body.read(CHUNK_SIZE)
+            if not chunk: return
+            yield chunk
+    else:
+        for chunk in body:
+            if chunk: yield chunk
+
+def _send_body(conn, body, length):
+    """
+Write a request body to ``conn``. Strings are sent as-is; regular files are
+memory-mapped and written straight from the page cache; anything else is
+streamed block by block using chunked transfer encoding.
+    """
+    if isinstance(body, basestring):
+        conn.send(body)
+    elif length is not None:
+        start = body.tell()
+        mm = mmap.mmap(body.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for i in xrange(start, start + length, CHUNK_SIZE):
+                conn.send(buffer(mm, i, min(CHUNK_SIZE, start + length - i)))
+        finally:
+            mm.close()
+        body.seek(start + length)
+    else:
+        for chunk in _iter_chunks(body):
+            conn.send("%x\r\n%s\r\n" % (len(chunk), chunk))
+        conn.send("0\r\n\r\n")
+
+def _rewind(body):
+    """
+Return a function which restores a body to its current position so it can be
+sent again, or None if the body cannot be replayed.
+    """
+    if isinstance(body, basestring):
+        return lambda: None
+    try:
+        pos = body.tell()
+    except (AttributeError, IOError, OSError):
+        return None
+    return lambda: body.seek(pos)
+
+# zlib window sizes selecting the gzip and zlib ("deflate") containers.
+_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+def _compress(body, encoding, level):
+    """
+Compress a request body with ``encoding`` ('gzip' or 'deflate'). Strings are
+compressed in one go; files and iterables are compressed block by block as
+they are sent, so the payload is never buffered in full.
+    """
+    z = zlib.compressobj(level, zlib.DEFLATED, _WBITS[encoding])
+    if isinstance(body, basestring):
+        return z.compress(body) + z.flush()
+    def blocks():
+        for chunk in _iter_chunks(body):
+            out = z.compress(chunk)
+            if out: yield out
+        yield z.flush()
+    return blocks()
+
+def _decompress(data, encoding):
+    """Decode a response body sent with the given Content-Encoding."""
+    if not encoding or encoding == 'identity':
+        return data
+    try:
+        if encoding in ('gzip', 'x-gzip'):
+            return zlib.decompress(data, 32 + zlib.MAX_WBITS)
+        if encoding == 'deflate':
+            try:
+                return zlib.decompress(data)
+            except zlib.error:
+                # some servers send raw deflate data without the zlib header
+                return zlib.decompress(data, -zlib.MAX_WBITS)
+    except zlib.error, e:
+        raise PrecogServiceError("invalid %s response: %s" % (encoding, e))
+    raise PrecogServiceError("unsupported content encoding %r" % encoding)
+
+class _RecordScanner(object):
+    """
+Finds record boundaries in a stream of jsonstream or CSV data.
+
+``boundary(block)`` returns the offset just past the last record terminator
+in ``block`` (or -1), carrying CSV quoting state from one block to the next
+so that newlines inside quoted fields are not mistaken for record ends.
+jsonstream data is expected to hold one value per line.
+    """
+    def __init__(self, format):
+        self.csv      = format['mime'] == 'text/csv'
+        self.quote    = format['params'].get('quote', '"')
+        self.escape   = format['params'].get('escape', '"')
+        self.in_quote = False
+        self.skip     = False
+
+    def boundary(self, block):
+        if not self.csv:
+            return block.rfind('\n') + 1 or -1
+        quote, escape = self.quote, self.escape
+        i, last, n = 0, -1, len(block)
+        if self.skip:
+            i, self.skip = 1, False
+        while i < n:
+            if not self.in_quote:
+                q = block.find(quote, i)
+                nl = block.rfind('\n', i, n if q < 0 else q)
+                if nl >= 0: last = nl + 1
+                if q < 0: break
+                self.in_quote, i = True, q + 1
+            elif escape != quote:
+                q = block.find(quote, i)
+                e = block.find(escape, i, n if q < 0 else q)
+                if e >= 0:
+                    i = e + 2
+                    if i > n: self.skip = True
+                elif q >= 0:
+                    self.in_quote, i = False, q + 1
+                else:
+                    break
+            else:
+                q = block.find(quote, i)
+                if q < 0: break
+                self.in_quote, i = False, q + 1
+        return last
+
+def _record_chunks(f, format, size):
+    """
+Split the data read from ``f`` into strings of roughly ``size`` bytes which
+each end on a record boundary. For CSV data the header line is repeated at
+the start of every chunk.
+    """
+    scanner = _RecordScanner(format)
+    header = ''
+    if scanner.csv:
+        while True:
+            block = f.readline()
+            header += block
+            if not block or scanner.boundary(block) > 0: break
+    pieces, n = [], 0
+    while True:
+        block = f.read(CHUNK_SIZE)
+        if not block: break
+        b = scanner.boundary(block)
+        if n + len(block) >= size and b > 0:
+            pieces.append(block[:b])
+            yield header + ''.join(pieces)
+            pieces, n = [block[b:]], len(block) - b
+        else:
+            pieces.append(block)
+            n += len(block)
+    rest = ''.join(pieces)
+    if rest.strip():
+        yield header + rest
+
+def _merge_receipts(receipts):
+    """
+Combine several ingest receipts into one: counts are added up and lists
+(such as ``errors``) are concatenated.
+    """
+    merged = {}
+    for r in receipts:
+        for k, v in r.iteritems():
+            if k not in merged:
+                merged[k] = list(v) if isinstance(v, list) else v
+            elif isinstance(v, list):
+                merged[k].extend(v)
+            elif isinstance(v, (int, long, float)) and not isinstance(v, bool):
+                merged[k] += v
+    return merged
+
+class _Posts(object):
+    """
+Runs ingest requests on a pool of ``concurrency`` threads, with at most two per
+thread waiting or in flight at once (so the caller stops producing bodies when
+the server falls behind). Results and errors are collected as ``(key, value)``
+pairs; once a request has failed, no more are started.
+    """
+    def __init__(self, concurrency):
+        self.slots   = threading.Semaphore(concurrency * 2)
+        self.workers = ThreadPool(concurrency)
+        self.results = []
+        self.errors  = []
+
+    def submit(self, key, fn, *args):
+        """Run ``fn(*args)`` once a slot is free; returns False if a request has failed."""
+        self.slots.acquire()
+        if self.errors:
+            self.slots.release()
+            return False
+        self.workers.apply_async(self._run, (key, fn, args))
+        return True
+
+    def _run(self, key, fn, args):
+        try:
+            self.results.append((key, fn(*args)))
+        except Exception, e:
+            self.errors.append((key, e))
+        finally:
+            self.slots.release()
+
+    def join(self):
+        """Wait for the started requests to finish."""
+        self.workers.close()
+        self.workers.join()
+
+# Objects being serialized by a process pool. The pool's workers are forked
+# while this is set, so they see the objects without them being pickled.
+_shard_source = None
+_shard_lock = threading.Lock()
+
+def _dumps_shard((codec, start, end)):
+    """Serialize ``_shard_source[start:end]`` as the inside of a JSON array."""
+    return _dumps_objs((codec, _shard_source[start:end]))
+
+def _dumps_objs((codec, objs)):
+    """Serialize ``objs`` as the inside of a JSON array."""
+    dumps = JsonCodec(codec).dumps
+    return _array_separator(dumps).join([dumps(obj) for obj in objs])
+
+def _array_separator(dumps):
+    """Return the string ``dumps`` writes between the items of an array (", " or ",")."""
+    return dumps([0, 0])[2:-2]
+
+def _sharded_json(objs, codec, processes, shard_size, pool=None):
+    """
+Yield the JSON array of ``objs`` (byte for byte what ``dumps(objs)`` returns)
+in pieces, serializing shards of ``shard_size`` objects on ``processes``
+worker processes. At most two shards per process are serialized ahead of the
+one being yielded.
+
+Without a ``pool``, one is forked for the call so that the workers inherit
+``objs`` instead of receiving them pickled. Forking a process while other
+threads run is hazardous: the child gets a copy of any lock another thread
+held at that moment (in ``logging``, say) which nothing will ever release.
+The workers only serialize JSON, but an application with threads of its own
+should pass a ``pool`` created before it started them; the shards are then
+pickled to its workers.
+    """
+    global _shard_source
+    name = None if codec.name == 'auto' else codec.name
+    if pool is None:
+        with _shard_lock:
+            _shard_source = objs
+            try:
+                workers = multiprocessing.Pool(processes)
+            finally:
+                _shard_source = None
+        shards = ((_dumps_shard, (name, i, i + shard_size))
+                  for i in xrange(0, len(objs), shard_size))
+    else:
+        workers = pool
+        shards = ((_dumps_objs, (name, objs[i:i + shard_size]))
+                  for i in xrange(0, len(objs), shard_size))
+    try:
+        sep = _array_separator(codec.dumps)
+        pending = collections.deque()
+        for fn, shard in itertools.islice(shards, processes * 2):
+            pending.append(workers.apply_async(fn, (shard,)))
+        yield "["
+        first = True
+        while pending:
+            s = pending.popleft().get()
+            for fn, shard in itertools.islice(shards, 1):
+                pending.append(workers.apply_async(fn, (shard,)))
+            if not first: yield sep
+            first = False
+            yield s
+        yield "]"
+    finally:
+        if pool is None:
+            workers.terminate()
+            workers.join()
+
+class _JsonStreamBody(object):
+    """
+A request body which serializes an iterable of Python objects as jsonstream
+(one JSON value per line) while it is being sent.
+
+With ``buffered`` greater than zero, the objects are serialized on a producer
+thread into blocks of about ``CHUNK_SIZE`` bytes, and at most ``buffered``
+blocks wait to be sent, so producing and uploading overlap while memory use
+stays bounded. Otherwise the objects are serialized as the body is read.
+Errors raised by the iterable are re-raised to the reader.
+    """
+    def __init__(self, objs, buffered=4, dumps=json.dumps):
+        self.objs     = objs
+        self.buffered = buffered
+        self.dumps    = dumps
+        self._closed  = False
+
+    def _blocks(self):
+        dumps, pieces, n = self.dumps, [], 0
+        for obj in self.objs:
+            line = dumps(obj) + "\n"
+            pieces.append(line)
+            n += len(line)
+            if n >= CHUNK_SIZE:
+                yield "".join(pieces)
+                pieces, n = [], 0
+        if pieces:
+            yield "".join(pieces)
+
+    def _produce(self, queue):
+        try:
+            for block in self._blocks():
+                queue.put((block, None))
+                if self._closed: return
+            queue.put((None, None))
+        except Exception:
+            queue.put((None, sys.exc_info()))
+
+    def __iter__(self):
+        if self.buffered <= 0:
+            for block in self._blocks():
+                yield block
+            return
+        queue = Queue.Queue(self.buffered)
+        t = threading.Thread(target=self._produce, args=(queue,), name='precog-serializer')
+        t.daemon = True
+        t.start()
+        try:
+            while True:
+                block, exc_info = queue.get()
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if block is None: return
+                yield block
+        finally:
+            # unblock the producer if the request was abandoned half way
+            self._closed = True
+            while True:
+                try:
+                    queue.get_nowait()
+                except Queue.Empty:
+                    break
+
+class QueryCache(object):
+    """
+In-process cache of query results.
+
+Pass a QueryCache to ``Precog`` (``Precog(..., cache=QueryCache())``) and
+repeated calls to ``query`` with the same host, base path, path, query and
+``detailed`` flag are answered from memory for up to ``ttl`` seconds. When
+full, the least recently used entry is evicted. Whenever the client appends,
+uploads or deletes data at a path, cached queries whose base path contains,
+or is contained in, that path are dropped.
+
+Cached results are shared between callers and should not be modified. The
+counters ``hits``, ``misses``, ``evictions`` and ``invalidations`` are
+available as attributes and through ``stats()``.
+
+Keyword Arguments:
+ * ttl (float): Seconds a result stays valid.
+ * max_entries (int): Maximum number of results kept.
+    """
+    def __init__(self, ttl=60.0, max_entries=1000):
+        self.ttl           = ttl
+        self.max_entries   = max_entries
+        self.hits          = 0
+        self.misses        = 0
+        self.evictions     = 0
+        self.invalidations = 0
+        self._entries      = collections.OrderedDict()
+        self._lock         = threading.Lock()
+
+    def get(self, key):
+        """Return ``(True, result)`` for a fresh cached entry, else ``(False, None)``."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return False, None
+            self._entries[key] = entry
+            self.hits += 1
+            return True, entry[2]
+
+    def put(self, key, result, querypath):
+        """Cache ``result`` for ``key``; ``querypath`` is the query's full base path."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, querypath, result)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, path):
+        """Drop every entry whose base path overlaps ``path``."""
+        with self._lock:
+            for key, entry in self._entries.items():
+                if _paths_overlap(entry[1], path):
+                    del self._entries[key]
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return a dictionary of cache counters."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'entries': len(self._entries)}
+
+class DiskQueryCache(object):
+    """
+Query result cache in an SQLite database on local disk, shared by every
+process (and thread) which opens the same file.
+
+DiskQueryCache has the same interface as ``QueryCache``: pass one to
+``Precog`` (``Precog(..., cache=DiskQueryCache('/var/cache/precog.db'))``) and
+query results are kept for ``ttl`` seconds, keyed by host, base path, path,
+query and ``detailed`` flag, so that worker processes, cron jobs and cold
+started clients reuse each other's results. Appends, uploads and deletes made
+through any client using the file drop the entries they affect.
+
+Results are stored as zlib-compressed JSON, and only read (through SQLite's
+memory-mapped I/O) when they are looked up. Once the stored results exceed
+``max_bytes``, expired entries and then the least recently used ones are
+evicted. The database uses write-ahead logging, so readers do not block each
+other or a writer. Errors from the database are logged and treated as cache
+misses, so a broken cache file never breaks queries.
+
+The counters ``hits``, ``misses``, ``evictions`` and ``invalidations`` count
+the operations of this object, and are available as attributes and through
+``stats()``.
+
+Arguments:
+ * filename (str): Path of the database file; created if needed.
+
+Keyword Arguments:
+ * ttl (float): Seconds a result stays valid.
+ * max_bytes (int): Maximum size of the stored (compressed) results.
+ * compress_level (int): zlib compression level, from 1 (fast) to 9 (small).
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS results (
+            key       TEXT PRIMARY KEY,
+            querypath TEXT NOT NULL,
+            expires   REAL NOT NULL,
+            accessed  REAL NOT NULL,
+            size      INTEGER NOT NULL,
+            data      BLOB NOT NULL);
+        CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);
+    """
+
+    def __init__(self, filename, ttl=60.0, max_bytes=64 * 1024 * 1024, compress_level=6):
+        import sqlite3
+        self.filename       = filename
+        self.ttl            = ttl
+        self.max_bytes      = max_bytes
+        self.compress_level = compress_level
+        self.hits           = 0
+        self.misses         = 0
+        self.evictions      = 0
+        self.invalidations  = 0
+        self._sqlite3       = sqlite3
+        self._local         = threading.local()
+        self._db()
+
+    def _db(self):
+        """Return this thread's connection, opening it (again, after a fork) if needed."""
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = self._sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+            db.text_factory = str
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA mmap_size=%d" % self.max_bytes)
+            db.create_function('overlaps', 2, _paths_overlap)
+            db.executescript(self.schema)
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    @staticmethod
+    def _key(key):
+        return json.dumps(list(key))
+
+    def get(self, key):
+        """Return ``(True, result)`` for a fresh cached entry, else ``(False, None)``."""
+        now = time.time()
+        try:
+            db = self._db()
+            row = db.execute("SELECT expires, accessed, data FROM results WHERE key = ?",
+                             (self._key(key),)).fetchone()
+            if row is None or row[0] < now:
+                self.misses += 1
+                return False, None
+            result = json.loads(zlib.decompress(row[2]))
+            # LRU order only needs to be roughly right: skip most of the writes
+            if now - row[1] > 1.0:
+                db.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, self._key(key)))
+        except (self._sqlite3.Error, zlib.error, ValueError), e:
+            log.warning("query cache %s: %s", self.filename, e)
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, result
+
+    def put(self, key, result, querypath):
+        """Cache ``result`` for ``key``; ``querypath`` is the query's full base path."""
+        data = zlib.compress(json.dumps(result), self.compress_level)
+        now = time.time()
+        try:
+            db = self._db()
+            db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                       (self._key(key), querypath, now + self.ttl, now, len(data),
+                        self._sqlite3.Binary(data)))
+            self._evict(db, now)
+        except self._sqlite3.Error, e:
+            log.warning("query cache %s: %s", self.filename, e)
+
+    def _evict(self, db, now):
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            self.evictions += db.execute("DELETE FROM results WHERE expires < ?", (now,)).rowcount
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            victims = []
+            for key, size in db.execute("SELECT key, size FROM results ORDER BY accessed"):
+                if total <= self.max_bytes: break
+                victims.append((key,))
+                total -= size
+            db.executemany("DELETE FROM results WHERE key = ?", victims)
+            self.evictions += len(victims)
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+    def invalidate(self, path):
+        """Drop every entry whose base path overlaps ``path``."""
+        try:
+            n = self._db().execute("DELETE FROM results WHERE overlaps(querypath, ?)", (path,)).rowcount
+            self.invalidations += n
+        except self._sqlite3.Error, e:
+            log.warning("query cache %s: %s", self.filename, e)
+
+    def clear(self):
+        self._db().execute("DELETE FROM results")
+
+    def stats(self):
+        """Return a dictionary of cache counters, and the size of the database."""
+        entries, size = self._db().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations, 'entries': entries, 'bytes': size}
+
+def _paths_overlap(p1, p2):
+    """Whether one Precog path is equal to, or a parent of, the other."""
+    s1, s2 = p1.strip('/'), p2.strip('/')
+    if not s1 or not s2 or s1 == s2: return True
+    return s1.startswith(s2 + '/') or s2.startswith(s1 + '/')
+
+class HedgePolicy(object):
+    """
+Settings and counters for hedged requests.
+
+When a client has a hedging policy, a GET request which has not been answered
+after a delay is sent a second time on another connection; whichever response
+arrives first is used and the other request is aborted. This trims the slow
+tail caused by an occasional slow server, at the price of some extra load.
+
+The delay is either fixed, or the given percentile of recent response times
+(no request is hedged until ``min_samples`` have been seen). At most
+``budget`` (a fraction) of requests are hedged. The counters ``requests``,
+``fired`` (hedges sent) and ``won`` (hedges answered first) are available as
+attributes and, with the current delay, through ``stats()``.
+
+Keyword Arguments:
+ * delay (float): Fixed delay in seconds before hedging, or None to use
+   ``percentile``.
+ * percentile (float): Percentile of recent latencies to use as the delay.
+ * min_delay (float): Lower bound for the delay, in seconds.
+ * window (int): Number of recent latencies to keep.
+ * min_samples (int): Latencies needed before a percentile delay is used.
+ * budget (float): Maximum fraction of requests which may be hedged.
+    """
+    def __init__(self, delay=None, percentile=95.0, min_delay=0.01, window=200,
+                 min_samples=20, budget=0.1):
+        self.delay       = delay
+        self.percentile  = percentile
+        self.min_delay   = min_delay
+        self.min_samples = min_samples
+        self.budget      = budget
+        self.requests    = 0
+        self.fired       = 0
+        self.won         = 0
+        self._latencies  = collections.deque(maxlen=window)
+        self._lock       = threading.Lock()
+
+    def start(self):
+        """Count a new request and return its hedging delay (None: no hedge)."""
+        with self._lock:
+            self.requests += 1
+            return self._delay()
+
+    def _delay(self):
+        if self.delay is not None:
+            return max(self.delay, self.min_delay)
+        if len(self._latencies) < self.min_samples:
+            return None
+        xs = sorted(self._latencies)
+        i = min(len(xs) - 1, int(len(xs) * self.percentile / 100.0))
+        return max(xs[i], self.min_delay)
+
+    def fire(self):
+        """Return True (and count it) if the budget allows another hedge."""
+        with self._lock:
+            if self.fired + 1 > self.budget * self.requests:
+                return False
+            self.fired += 1
+            return True
+
+    def finish(self, latency, won):
+        with self._lock:
+            self._latencies.append(latency)
+            if won: self.won += 1
+
+    def stats(self):
+        """Return a dictionary of hedging counters and the current delay."""
+        with self._lock:
+            return {'requests': self.requests, 'fired': self.fired, 'won': self.won,
+                    'delay': self._delay()}
+
+class _Attempt(object):
+    """
+One of several racing requests, which another thread may abort by shutting
+down its connection's socket.
+    """
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.conn    = None
+        self.aborted = False
+
+    def use(self, conn):
+        with self.lock:
+            if self.aborted:
+                conn.close()
+                raise PrecogClientError("request cancelled")
+            self.conn = conn
+
+    def release(self):
+        """Stop tracking the connection; returns False if it was aborted."""
+        with self.lock:
+            self.conn = None
+            return not self.aborted
+
+    def abort(self):
+        with self.lock:
+            self.aborted = True
+            if self.conn is not None and self.conn.sock is not None:
+                try:
+                    self.conn.sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+class Histogram(object):
     """
+A latency histogram with fixed bucket boundaries (in seconds). Percentiles
+are estimated as the upper bound of the bucket they fall in.
+    """
+    bounds = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+              1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.bounds)
+        self.count  = 0
+        self.sum    = 0.0
+        self.min    = None
+        self.max    = None
+
+    def add(self, x):
+        self.counts[bisect.bisect_left(self.bounds, x)] += 1
+        self.count += 1
+        self.sum += x
+        self.min = x if self.min is None else min(self.min, x)
+        self.max = x if self.max is None else max(self.max, x)
+
+    def percentile(self, p):
+        if not self.count: return None
+        n = self.count * p / 100.0
+        seen = 0
+        for bound, c in zip(self.bounds, self.counts):
+            seen += c
+            if seen >= n: return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+                'buckets': [(b, c) for b, c in zip(self.bounds, self.counts) if c]}
+
+class MetricsRegistry(object):
+    """
+In-process registry of request metrics.
+
+Pass a MetricsRegistry to ``Precog`` (``Precog(..., metrics=MetricsRegistry())``)
+and every request records a sample: its method, endpoint class ('ingest',
+'analytics', 'accounts' or 'other'), HTTP status, bytes sent and received,
+and the time spent in each phase:
+
+ * connect: opening the TCP connection (only for new connections).
+ * tls: the TLS handshake (only for new HTTPS connections).
+ * send: writing the request headers and body.
+ * ttfb: waiting for the response headers.
+ * read: reading the response body.
+ * decode: decoding the JSON response.
+ * total: the whole request.
+
+Samples are aggregated per endpoint class into counters and latency
+histograms, which ``snapshot`` returns as a dictionary (suitable for
+``json.dumps``). Functions added with ``add_listener`` are called with each
+raw sample, to forward them to other telemetry systems.
+    """
+    def __init__(self):
+        self._lock      = threading.Lock()
+        self._listeners = []
+        self.reset()
+
+    def reset(self):
+        """Forget all recorded metrics."""
+        with self._lock:
+            self._endpoints = {}
+
+    def add_listener(self, fn):
+        """Call ``fn(sample)`` for every recorded request."""
+        self._listeners.append(fn)
+
+    def remove_listener(self, fn):
+        self._listeners.remove(fn)
+
+    def sample(self, method, path):
+        """Return a new, empty sample for a request."""
+        return {'method': method, 'endpoint': _endpoint_class(path), 'path': path,
+                'status': None, 'error': None, 'bytes_sent': 0, 'bytes_received': 0,
+                'phases': {}}
+
+    def record(self, sample):
+        """Add a completed sample to the registry."""
+        with self._lock:
+            e = self._endpoints.get(sample['endpoint'])
+            if e is None:
+                e = self._endpoints[sample['endpoint']] = {
+                    'requests': 0, 'errors': 0, 'bytes_sent': 0, 'bytes_received': 0,
+                    'status': collections.defaultdict(int),
+                    'latency': collections.defaultdict(Histogram)}
+            e['requests'] += 1
+            if sample['error']: e['errors'] += 1
+            if sample['status'] is not None: e['status'][sample['status']] += 1
+            e['bytes_sent'] += sample['bytes_sent']
+            e['bytes_received'] += sample['bytes_received']
+            for phase, t in sample['phases'].iteritems():
+                e['latency'][phase].add(t)
+        for fn in self._listeners:
+            _run_callback(fn, sample)
+
+    def snapshot(self):
+        """Return the current counters and histograms, per endpoint class."""
+        with self._lock:
+            out = {}
+            for name, e in self._endpoints.iteritems():
+                out[name] = {
+                    'requests': e['requests'], 'errors': e['errors'],
+                    'bytes_sent': e['bytes_sent'], 'bytes_received': e['bytes_received'],
+                    'status': dict(e['status']),
+                    'latency': dict((k, h.snapshot()) for k, h in e['latency'].iteritems())}
+            return out
+
+def _endpoint_class(path):
+    for name in ('ingest', 'analytics', 'accounts'):
+        if path.startswith('/%s/' % name): return name
+    return 'other'
+
+class _Limit(object):
+    """Flow-control state of one endpoint class of an ``AdaptiveLimiter``."""
+    def __init__(self, limit, rate, burst):
+        self.limit         = float(limit)
+        self.rate          = rate
+        self.burst         = burst
+        self.tokens        = burst
+        self.stamp         = time.time()
+        self.in_flight     = 0
+        self.baseline      = None
+        self.successes     = 0
+        self.last_decrease = 0
+        self.requests      = 0
+        self.throttled     = 0
+        self.waited        = 0.0
+        self.increases     = 0
+        self.decreases     = 0
+        self.congestion    = 0
+
+class AdaptiveLimiter(object):
+    """
+Client-side rate and concurrency control, kept separately for each endpoint
+class ('ingest', 'analytics', 'accounts' or 'other').
+
+Pass an AdaptiveLimiter to ``Precog`` (``Precog(..., limiter=AdaptiveLimiter())``)
+and every request first waits for a free slot under its class's concurrency
+limit, and for a token from its class's token bucket if a ``rate`` is set.
+
+The concurrency limit adapts AIMD-style: it grows by one each time a full
+limit's worth of requests has succeeded, and is multiplied by ``backoff`` on a
+congestion signal: a connection error, a 429 or 5xx response, or a latency
+above ``latency_factor`` times the lowest latency seen (and at least
+``latency_slack`` seconds more). Only requests sent after the last decrease can
+cause another one, so a burst of errors backs off once.
+
+``stats`` returns the current limits and counters, including ``throttled``
+(requests which had to wait) and ``waited`` (total seconds spent waiting).
+Functions added with ``add_listener`` are called with a dictionary for each
+'increase', 'decrease' and 'throttle' event.
+
+Keyword Arguments:
+ * initial (int): Initial concurrency limit.
+ * min_limit (int): Lowest concurrency limit.
+ * max_limit (int): Highest concurrency limit.
+ * backoff (float): Factor applied to the limit on congestion.
+ * latency_factor (float): Latency increase treated as congestion.
+ * latency_slack (float): Smallest latency increase, in seconds, treated as
+   congestion.
+ * rate (float or dict): Maximum requests per second, either for every class
+   or as a dictionary by class (defaults to None, no rate limit).
+ * burst (int): Requests which may be sent at once above ``rate`` (defaults
+   to one second's worth).
+    """
+    def __init__(self, initial=4, min_limit=1, max_limit=64, backoff=0.5, latency_factor=3.0,
+                 latency_slack=0.05, rate=None, burst=None):
+        self.initial        = initial
+        self.min_limit      = min_limit
+        self.max_limit      = max_limit
+        self.backoff        = backoff
+        self.latency_factor = latency_factor
+        self.latency_slack  = latency_slack
+        self.rate           = rate
+        self.burst          = burst
+        self._limits        = {}
+        self._listeners     = []
+        self._cond          = threading.Condition()
+
+    def add_listener(self, fn):
+        """Call ``fn(event)`` for every change of limit and every throttled request."""
+        self._listeners.append(fn)
+
+    def remove_listener(self, fn):
+        self._listeners.remove(fn)
+
+    def _limit(self, endpoint):
+        l = self._limits.get(endpoint)
+        if l is None:
+            rate = self.rate.get(endpoint) if isinstance(self.rate, dict) else self.rate
+            burst = self.burst if self.burst is not None else max(1, int(rate or 1))
+            l = self._limits[endpoint] = _Limit(self.initial, rate, burst)
+        return l
+
+    def _notify(self, endpoint, event, l):
+        d = {'endpoint': endpoint, 'event': event, 'limit': int(l.limit), 'in_flight': l.in_flight}
+        for fn in self._listeners:
+            _run_callback(fn, d)
+
+    def acquire(self, endpoint):
+        """Wait until a request to the ``endpoint`` class may be sent."""
+        t0 = time.time()
+        delay, waited = 0, False
+        with self._cond:
+            l = self._limit(endpoint)
+            while l.in_flight >= max(1, int(l.limit)):
+                waited = True
+                self._cond.wait()
+            l.in_flight += 1
+            if l.rate:
+                # take a token now, sleeping off any debt outside the lock
+                now = time.time()
+                l.tokens = min(l.burst, l.tokens + (now - l.stamp) * l.rate)
+                l.stamp = now
+                l.tokens -= 1
+                if l.tokens < 0:
+                    delay = -l.tokens / l.rate
+            if waited or delay:
+                l.throttled += 1
+        if delay:
+            time.sleep(delay)
+        if waited or delay:
+            with self._cond:
+                l.waited += time.time() - t0
+            self._notify(endpoint, 'throttle', l)
+
+    def release(self, endpoint, latency=None, congested=False):
+        """
+Report the end of a request to the ``endpoint`` class, which took ``latency``
+seconds; ``congested`` is True if the server signalled overload.
+        """
+        event = None
+        with self._cond:
+            l = self._limit(endpoint)
+            l.in_flight -= 1
+            l.requests += 1
+            now = time.time()
+            if latency is not None and not congested:
+                if l.baseline is not None and latency > max(self.latency_factor * l.baseline,
+                                                            l.baseline + self.latency_slack):
+                    congested = True
+                elif l.baseline is None or latency < l.baseline:
+                    l.baseline = latency
+                else:
+                    # let the baseline follow a slowly rising latency
+                    l.baseline += (latency - l.baseline) * 0.01
+            if congested:
+                l.congestion += 1
+                if latency is None or now - latency >= l.last_decrease:
+                    l.limit = max(self.min_limit, l.limit * self.backoff)
+                    l.last_decrease = now
+                    l.successes = 0
+                    l.decreases += 1
+                    event = 'decrease'
+            else:
+                l.successes += 1
+                if l.successes >= l.limit and l.limit < self.max_limit:
+                    l.limit = min(self.max_limit, int(l.limit) + 1)
+                    l.successes = 0
+                    l.increases += 1
+                    event = 'increase'
+            self._cond.notify_all()
+        if event is not None:
+            if event == 'decrease':
+                log.info("reducing %s concurrency to %d", endpoint, int(l.limit))
+            self._notify(endpoint, event, l)
+
+    def stats(self):
+        """Return the current limit and counters of each endpoint class."""
+        with self._cond:
+            return dict((name, {'limit': int(l.limit), 'in_flight': l.in_flight, 'rate': l.rate,
+                                'requests': l.requests, 'throttled': l.throttled,
+                                'waited': l.waited, 'increases': l.increases,
+                                'decreases': l.decreases, 'congestion': l.congestion})
+                        for name, l in self._limits.iteritems())
+
+def _congested(e):
+    """Tell whether a request error signals an overloaded server."""
+    if isinstance(e, PrecogServiceError):
+        return e.status == 429 or e.status >= 500
+    return isinstance(e, (socket.error, HTTPException))
 
 class Format(object):
     """
@@ -70,6 +1381,79 @@ Format.csv        = Format.makecsv()
 Format.tsv        = Format.makecsv(delim='\t')
 Format.ssv        = Format.makecsv(delim=';')
 
+class JsonCodec(object):
+    """
+A JSON encoder and decoder used by ``Precog`` for request and response bodies.
+
+``JsonCodec()`` picks the fastest available implementation for each
+direction, with the results of the standard ``json`` module: decoding uses
+ujson when it is installed (falling back to ``json`` for the few documents
+ujson rejects, such as integers beyond 64 bits), and encoding uses simplejson
+when it is installed, which produces exactly the output of ``json.dumps``.
+ujson can also be chosen for encoding with ``JsonCodec('ujson')``; it is
+faster still, but writes floats with at most 15 significant digits.
+
+Keyword Arguments:
+ * name (str): 'json', 'simplejson' or 'ujson' to use that library for both
+   directions (defaults to None, the fastest available).
+    """
+    def __init__(self, name=None):
+        if name is None:
+            self.dumps = _json_dumps('simplejson') or json.dumps
+            self.loads = _json_loads('ujson') or json.loads
+            self.name  = 'auto'
+        else:
+            self.dumps = _json_dumps(name)
+            self.loads = _json_loads(name)
+            if self.dumps is None or self.loads is None:
+                raise PrecogClientError("JSON library %r is not available" % name)
+            self.name  = name
+
+    def __repr__(self):
+        return "JsonCodec(%r)" % self.name
+
+def _json_dumps(name):
+    """Return the encoding function of a JSON library, or None if it is missing."""
+    if name == 'json':
+        return json.dumps
+    if name == 'simplejson':
+        try:
+            import simplejson
+        except ImportError:
+            return None
+        # namedtuples are arrays and Decimals are rejected, as with json.dumps
+        return simplejson.JSONEncoder(namedtuple_as_object=False, use_decimal=False).encode
+    if name == 'ujson':
+        try:
+            import ujson
+        except ImportError:
+            return None
+        return lambda obj: ujson.dumps(obj, double_precision=15, escape_forward_slashes=False)
+    raise PrecogClientError("unknown JSON library %r" % name)
+
+def _json_loads(name):
+    """Return the decoding function of a JSON library, or None if it is missing."""
+    if name == 'json':
+        return json.loads
+    if name == 'simplejson':
+        try:
+            import simplejson
+        except ImportError:
+            return None
+        return simplejson.loads
+    if name == 'ujson':
+        try:
+            import ujson
+        except ImportError:
+            return None
+        def loads(s):
+            try:
+                return ujson.loads(s, precise_float=True)
+            except (ValueError, OverflowError):
+                return json.loads(s)
+        return loads
+    raise PrecogClientError("unknown JSON library %r" % name)
+
 class Precog(object):
     """
 Client for the Precog API. This class contains all the functionality provided
@@ -86,56 +1470,366 @@ Keyword Arguments:
  * host (str): Host name to connect to.
  * port (int): Port to connect to.
  * https (bool): Whether to connect to host using HTTPS.
+ * pool (ConnectionPool): Pool of keep-alive connections to use (defaults to
+   the shared ``precog.default_pool``).
+ * compress (str): Compress request bodies with 'gzip' or 'deflate' (defaults
+   to None, no compression).
+ * compress_level (int): zlib compression level, from 1 (fast) to 9 (small).
+ * compress_min_size (int): Bodies smaller than this many bytes are sent
+   uncompressed.
+ * accept_compressed (bool): Ask the server for compressed responses, which
+   are decompressed transparently.
+ * cache (QueryCache or DiskQueryCache): Cache for query results (defaults to
+   None, no caching).
+ * hedge (HedgePolicy): Hedge GET requests (``query``, ``search_account``,
+   ``account_details``) to cut tail latency (defaults to None, no hedging).
+ * metrics (MetricsRegistry): Registry recording the timings of each request
+   (defaults to None, no metrics).
+ * codec (JsonCodec or str): JSON codec, or the name of a JSON library, used
+   to encode events and decode responses (defaults to the fastest available).
+ * hosts (HostPool or list): Several endpoints to spread requests over, used
+   instead of ``host``, ``port`` and ``https`` (see ``HostPool``).
+ * limiter (AdaptiveLimiter): Rate and concurrency control for requests
+   (defaults to None, no limits).
     """
-    def __init__(self, apikey, accountid, basepath=None, host='beta.precog.com', port=443, https=True):
+    def __init__(self, apikey, accountid, basepath=None, host='beta.precog.com', port=443, https=True, pool=None,
+                 compress=None, compress_level=6, compress_min_size=1024, accept_compressed=True,
+                 cache=None, hedge=None, metrics=None, codec=None, hosts=None, limiter=None):
+        if compress not in (None, 'gzip', 'deflate'):
+            raise PrecogClientError("unsupported compression %r" % compress)
         if basepath is None: basepath = accountid
+        if hosts is not None and not isinstance(hosts, HostPool):
+            hosts = HostPool(hosts)
+        if hosts is not None:
+            host, port, https = hosts.endpoints[0].key
         self.apikey    = apikey
         self.accountid = accountid
         self.basepath  = basepath
         self.host      = host
         self.port      = port
         self.https     = https
+        self.pool      = default_pool if pool is None else pool
 
-    def _connect(self):
-        s = "%s:%s" % (self.host, self.port)
-        if self.https:
-            return HTTPSConnection(s)
-        else:
-            return HTTPConnection(s)
+        self.compress          = compress
+        self.compress_level    = compress_level
+        self.compress_min_size = compress_min_size
+        self.accept_compressed = accept_compressed
+        self.cache             = cache
+        self.hedge             = hedge
+        self.metrics           = metrics
+        self.codec             = codec if isinstance(codec, JsonCodec) else JsonCodec(codec)
+        self.hosts             = hosts
+        self.limiter           = limiter
 
     def _post(self, path, body='', params={}, headers={}):
-        return self._doit('POST', self._connect(), path, body, params, headers)
+        return self._doit('POST', path, body, params, headers)
 
     def _get(self, path, body='', params={}, headers={}):
-        return self._doit('GET', self._connect(), path, body, params, headers)
+        return self._doit('GET', path, body, params, headers)
 
     def _delete(self, path, body='', params={}, headers={}):
-        return self._doit('DELETE', self._connect(), path, body, params, headers, void=True)
+        return self._doit('DELETE', path, body, params, headers, void=True)
+
+    def _encode(self, body, headers):
+        """Apply content encodings to a request; returns the new body and headers."""
+        headers = dict(headers)
+        if self.accept_compressed:
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        length = _body_length(body)
+        if self.compress and (length is None or length >= self.compress_min_size):
+            body = _compress(body, self.compress, self.compress_level)
+            headers['Content-Encoding'] = self.compress
+        return body, headers
+
+    def _request(self, conn, name, path, body, headers):
+        body, headers = self._encode(body, headers)
+        length = _body_length(body)
+        conn.putrequest(name, path, skip_accept_encoding='Accept-Encoding' in headers)
+        for k, v in headers.iteritems():
+            conn.putheader(k, v)
+        if length is None:
+            conn.putheader('Transfer-Encoding', 'chunked')
+        else:
+            conn.putheader('Content-Length', str(length))
+        if isinstance(body, basestring):
+            conn.endheaders(body)
+        else:
+            conn.endheaders()
+            _send_body(conn, body, length)
+
+    def _open(self, name, path, body, headers, attempt=None, sample=None):
+        """
+Send a request over a pooled connection and return ``(conn, response)`` once
+the response headers have arrived. A reused connection that the server closed
+while it was idle is retried once on a fresh connection, as long as the body
+can be replayed and either sending the request failed or it is a GET or
+DELETE (a POST whose response was lost may already have been processed). If an
+``_Attempt`` is given, it can be used by another thread to abort the request.
+Timings and byte counts are added to ``sample``, if given.
+        """
+        if self.hosts is None:
+            return self._open_on((self.host, self.port, self.https), name, path, body,
+                                 headers, attempt, sample)
+        # only GET requests are safe to retry on another endpoint
+        retries = len(self.hosts.endpoints) - 1 if name == 'GET' else 0
+        while True:
+            key = self.hosts.acquire()
+            t0 = time.time()
+            try:
+                conn, response = self._open_on(key, name, path, body, headers, attempt, sample)
+            except (socket.error, HTTPException):
+                self.hosts.release(key, time.time() - t0, False)
+                if retries <= 0: raise
+                retries -= 1
+                continue
+            except:
+                self.hosts.release(key)
+                raise
+            self.hosts.release(key, time.time() - t0, response.status < 500)
+            return conn, response
 
-    def _doit(self, name, conn, path, body, params, headers, void=False):
-        path = "%s?%s" % (pathname2url(path), urlencode(params.items()))
+    def _open_on(self, key, name, path, body, headers, attempt=None, sample=None):
+        """Like ``_open``, for the endpoint ``key``, a ``(host, port, https)`` tuple."""
+        conn, reused = self.pool.get(*key)
+        conn.endpoint = key
+        rewind = _rewind(body)
+        while True:
+            sending = True
+            try:
+                if attempt is not None: attempt.use(conn)
+                sent = getattr(conn, 'sent', 0)
+                t0 = time.time()
+                self._request(conn, name, path, body, headers)
+                t1 = time.time()
+                sending = False
+                response = conn.getresponse()
+                # connect/TLS times are only reported by the request which opened the connection
+                timings, conn.timings = getattr(conn, 'timings', None) or {}, None
+                if sample is not None:
+                    sample['phases'].update(timings)
+                    sample['phases']['send'] = t1 - t0 - sum(timings.values())
+                    sample['phases']['ttfb'] = time.time() - t1
+                    sample['bytes_sent'] = getattr(conn, 'sent', 0) - sent
+                return conn, response
+            except (socket.error, HTTPException):
+                conn.close()
+                if not reused or rewind is None: raise
+                # once the request is sent the server may have acted on it, so
+                # only requests which are safe to repeat are sent again
+                if not sending and name not in ('GET', 'DELETE'): raise
+                rewind()
+                conn, reused = self.pool.create(*key), False
+                conn.endpoint = key
+            except:
+                # e.g. the body failed: the request is half written
+                conn.close()
+                raise
 
+    def _release(self, conn):
+        """Return a connection opened by ``_open`` to the pool."""
+        host, port, https = conn.endpoint
+        self.pool.put(host, port, https, conn)
+
+    def _send(self, name, path, body, headers, attempt=None, sample=None):
+        """Send a request and read the whole (decompressed) response."""
+        conn, response = self._open(name, path, body, headers, attempt, sample)
+        try:
+            t0 = time.time()
+            data = response.read()
+        except:
+            conn.close()
+            raise
+        if sample is not None:
+            sample['phases']['read'] = time.time() - t0
+            sample['bytes_received'] = len(data)
+        if attempt is None or attempt.release():
+            self._release(conn)
+        else:
+            conn.close()
+        data = _decompress(data, response.getheader('content-encoding'))
+        return response, data
+
+    def _send_hedged(self, name, path, body, headers, sample=None):
+        """
+Send a request, and if no response has arrived after the hedging policy's
+delay, send it again on another connection. The first successful response is
+returned and the other request is aborted. The timings and byte counts of the
+request which won are added to ``sample``, if given.
+        """
+        policy = self.hedge
+        delay = policy.start()
+        t0 = time.time()
+        if delay is None:
+            result = self._send(name, path, body, headers, sample=sample)
+            policy.finish(time.time() - t0, False)
+            return result
+        attempts = (_Attempt(), _Attempt())
+        samples = [None, None] if sample is None else [{'phases': {}}, {'phases': {}}]
+        race = {'done': False, 'winner': None, 'result': None, 'errors': [], 'running': 1}
+        cond = threading.Condition()
+
+        def finish(i, result, exc_info):
+            if race['done']: return
+            if exc_info is None:
+                race.update(done=True, winner=i, result=result)
+                attempts[1 - i].abort()
+            else:
+                race['errors'].append(exc_info)
+                race['running'] -= 1
+                race['done'] = race['running'] == 0
+            cond.notify_all()
+
+        def attempt(i):
+            try:
+                r, e = self._send(name, path, body, headers, attempts[i], samples[i]), None
+            except Exception:
+                r, e = None, sys.exc_info()
+            with cond:
+                finish(i, r, e)
+
+        def hedge():
+            time.sleep(delay)
+            with cond:
+                if race['done'] or not policy.fire(): return
+                race['running'] += 1
+            attempt(1)
+
+        t = threading.Thread(target=hedge, name='precog-hedge')
+        t.daemon = True
+        t.start()
+        attempt(0)
+        with cond:
+            while not race['done']:
+                cond.wait()
+        policy.finish(time.time() - t0, race['winner'] == 1)
+        if race['winner'] is None:
+            t, v, tb = race['errors'][0]
+            raise t, v, tb
+        if sample is not None:
+            won = samples[race['winner']]
+            sample['phases'].update(won.pop('phases'))
+            sample.update(won)
+        return race['result']
+
+    def _stream(self, name, path, body, params, headers):
+        """
+Send a request and return a ``_ResponseStream`` from which the response body
+can be read incrementally. Error responses are read in full and raised.
+        """
+        url = self._url(path, params)
+        endpoint = _endpoint_class(path)
+        sample = None if self.metrics is None else self.metrics.sample(name, path)
+        if self.limiter is not None:
+            self.limiter.acquire(endpoint)
+        t0 = time.time()
+        def done(stream, error):
+            # the limiter judges the time to answer, not the size of the result
+            if self.limiter is not None:
+                self.limiter.release(endpoint, latency, error is not None and _congested(error))
+            if sample is not None:
+                sample['bytes_received'] = stream.received
+                sample['phases']['read'] = time.time() - t1
+                self._record(sample, t0, error)
+        try:
+            conn, response = self._open(name, url, body, headers, sample=sample)
+            t1 = time.time()
+            latency = t1 - t0
+            if response.status not in [200, 202]:
+                data = response.read()
+                self._release(conn)
+                data = _decompress(data, response.getheader('content-encoding'))
+                self._response(url, body, params, headers, response.status, response.reason,
+                               data, True, sample)
+            if sample is not None:
+                sample['status'] = response.status
+            # the limiter slot and sample are released once the body has been read
+            return _ResponseStream(self, conn, response, done)
+        except Exception, e:
+            if self.limiter is not None:
+                self.limiter.release(endpoint, time.time() - t0, _congested(e))
+            if sample is not None: self._record(sample, t0, e)
+            raise
+
+    def _url(self, path, params):
+        if isinstance(params, _PreparedParams):
+            return params.url
+        return "%s?%s" % (pathname2url(path), urlencode(params.items()))
+
+    def _doit(self, name, path, body, params, headers, void=False):
+        url = self._url(path, params)
+        exchange = lambda sample: self._exchange(name, url, body, params, headers, void, sample)
+        return self._limited(path, lambda: self._measure(name, path, exchange))
+
+    def _limited(self, path, fn):
+        """Return ``fn()``, run within the limiter's limits for ``path`` (if any)."""
+        if self.limiter is None:
+            return fn()
+        endpoint = _endpoint_class(path)
+        self.limiter.acquire(endpoint)
+        t0 = time.time()
+        try:
+            result = fn()
+        except Exception, e:
+            self.limiter.release(endpoint, time.time() - t0, _congested(e))
+            raise
+        self.limiter.release(endpoint, time.time() - t0)
+        return result
+
+    def _measure(self, name, path, fn):
+        """Return ``fn(sample)``, recording the sample if the client has metrics."""
+        if self.metrics is None:
+            return fn(None)
+        sample = self.metrics.sample(name, path)
+        t0 = time.time()
+        try:
+            result = fn(sample)
+        except Exception, e:
+            self._record(sample, t0, e)
+            raise
+        self._record(sample, t0)
+        return result
+
+    def _record(self, sample, t0, error=None):
+        """Record a sample for a request started at ``t0`` which raised ``error``, if any."""
+        if error is not None:
+            sample['error'] = error.__class__.__name__
+        sample['phases']['total'] = time.time() - t0
+        self.metrics.record(sample)
+
+    def _exchange(self, name, url, body, params, headers, void, sample):
         # Send request and get response
-        conn.request(name, path, body, headers)
-        response = conn.getresponse()
-        data = response.read()
+        if name == 'GET' and self.hedge is not None:
+            response, data = self._send_hedged(name, url, body, headers, sample)
+        else:
+            response, data = self._send(name, url, body, headers, sample=sample)
+        return self._response(url, body, params, headers,
+                              response.status, response.reason, data, void, sample)
 
-        debugurl = "%s:%s%s" % (self.host, self.port, path)
+    def _response(self, url, body, params, headers, status, reason, data, void, sample=None):
+        debugurl = "%s:%s%s" % (self.host, self.port, url)
+        if sample is not None:
+            sample['status'] = status
 
         # Check HTTP status code
-        if response.status not in [200, 202]:
+        if status not in [200, 202]:
             fmt = "%s body=%r params=%r headers=%r returned non-200 status (%d): %s [%s]"
-            msg = fmt % (debugurl, body, params, headers, response.status, response.reason, data)
-            raise PrecogServiceError(msg)
+            msg = fmt % (debugurl, body, params, headers, status, reason, data)
+            e = PrecogServiceError(msg)
+            e.status = status
+            raise e
 
         if void:
             return None
 
         # Try parsing JSON response
         try:
-            return json.loads(data)
+            t0 = time.time()
+            result = self.codec.loads(data)
         except ValueError, e:
             raise PrecogServiceError('invalid json response %r' % data)
+        if sample is not None:
+            sample['phases']['decode'] = time.time() - t0
+        return result
 
     def _auth(self, user, password):
         s = standard_b64encode("%s:%s" % (user, password))
@@ -152,7 +1846,7 @@ Arguments:
  * email (str): The email address for the new account.
  * password (str): The password for the new account.
         """
-        body = json.dumps({"email": email, "password": password})
+        body = self.codec.dumps({"email": email, "password": password})
         headers = { 'Content-Type': Format.json["mime"] }
         return self._post('/accounts/v1/accounts/', body=body, headers=headers)
 
@@ -194,39 +1888,154 @@ Arguments:
  * dest (str): Precog path to append the object to.
  * obj (json): The Python object to be appended.
         """
-        return self._ingest(dest, Format.json, json.dumps([obj]), mode='batch', receipt='true')
+        return self._ingest(dest, Format.jsonstream, self.codec.dumps(obj), mode='batch', receipt='true')
 
-    def append_all(self, dest, objs):
+    def append_all(self, dest, objs, processes=1, shard_size=10000, pool=None):
         """
 Appends an list of JSON object to the destination path. Each object must be a
 Python object representing a single JSON value: a dictionary, list, number,
 string, boolean, or None. The objects should be provided in a list.
 
+Any other iterable (such as a generator) is streamed with ``append_stream``.
+
+For very large lists, ``processes`` greater than one splits the list into
+shards of ``shard_size`` objects which are serialized by that many worker
+processes, while the finished shards are sent in order. The data sent is
+exactly the same as with a single process. The workers are forked for each
+call unless a ``multiprocessing.Pool`` is given; forking while other threads
+are running can leave a worker stuck on a lock one of them held, so
+multi-threaded applications should create a pool up front and pass it in.
+
 Arguments:
  * dest (str): Precog path to append the object to.
  * objs (list): The list of Python objects to be appended.
+
+Keyword Arguments:
+ * processes (int): Number of processes serializing the list (with a ``pool``,
+   its size).
+ * shard_size (int): Number of objects serialized at a time by each process.
+ * pool (multiprocessing.Pool): Worker processes to use instead of forking new
+   ones; the shards are pickled to them.
         """
-        return self._ingest(dest, Format.json, json.dumps(objs), mode='batch', receipt='true')
+        if not isinstance(objs, (list, tuple, dict)) and hasattr(objs, '__iter__'):
+            return self.append_stream(dest, objs)
+        if processes > 1 and isinstance(objs, (list, tuple)) and len(objs) > shard_size:
+            body = _sharded_json(objs, self.codec, processes, shard_size, pool)
+            return self._ingest(dest, Format.json, body, mode='batch', receipt='true')
+        return self._ingest(dest, Format.json, self.codec.dumps(objs), mode='batch', receipt='true')
 
-    def append_all_from_file(self, dest, format, src):
+    def append_stream(self, dest, objs, buffered=4):
         """
-Given a file and a format, append all the data from the file to the destination
-path. The ``format`` should be one of those provided by the ``precog.Format``
-class (e.g. ``Format.json``).
+Appends the objects produced by an iterable (for instance a generator) to the
+destination path. The objects are serialized as ``Format.jsonstream`` while
+the request is being sent, on a separate thread, so the iterable is never held
+in memory in full and producing the objects overlaps with uploading them.
 
 Arguments:
- * dest (str): Precog path to append the object to.
+ * dest (str): Precog path to append the objects to.
+ * objs (iterable): The Python objects to be appended.
+
+Keyword Arguments:
+ * buffered (int): Number of serialized blocks (of ``CHUNK_SIZE`` bytes) that
+   may wait to be sent. Zero serializes on the sending thread instead.
+        """
+        objs = iter(objs)
+        try:
+            first = next(objs)
+        except StopIteration:
+            raise PrecogClientError("no bytes to ingest")
+        body = _JsonStreamBody(itertools.chain([first], objs), buffered, self.codec.dumps)
+        return self._ingest(dest, Format.jsonstream, body, mode='batch', receipt='true')
+
+    def append_routed(self, objs, key_fn, concurrency=8, max_bytes=1024 * 1024,
+                      max_buffered_bytes=16 * 1024 * 1024):
+        """
+Appends each object of an iterable to the path returned by ``key_fn(obj)``.
+
+The objects are serialized and grouped by path as they are read. A path's
+group is posted (as ``Format.jsonstream``) once it reaches ``max_bytes``, or
+when all groups together reach ``max_buffered_bytes`` (the largest group is
+posted first), and the rest at the end. Up to ``concurrency`` groups are
+posted at once over pooled connections.
+
+Returns a dictionary of receipts by path, each combining the receipts of all
+the groups posted to that path. If a post fails, no more objects are read, the
+posts already started complete, and then the first error is raised with the
+receipts of the groups that were ingested as ``receipts`` and a list of
+``(path, error)`` pairs as ``errors``. Objects read but not yet posted are
+dropped.
+
+Arguments:
+ * objs (iterable): The Python objects to be appended.
+ * key_fn (function): Returns the Precog path for an object.
+
+Keyword Arguments:
+ * concurrency (int): Maximum number of groups being posted at once.
+ * max_bytes (int): Post a path's group once it reaches this size.
+ * max_buffered_bytes (int): Maximum size of all the groups being built.
+        """
+        posts = _Posts(concurrency)
+        buffers, total = {}, 0
+        def submit(dest):
+            lines, n = buffers.pop(dest)
+            return posts.submit(dest, self._ingest, dest, Format.jsonstream, ''.join(lines),
+                                'batch', 'true')
+        try:
+            dumps = self.codec.dumps
+            for obj in objs:
+                dest = key_fn(obj)
+                line = dumps(obj) + "\n"
+                buf = buffers.get(dest)
+                if buf is None:
+                    buf = buffers[dest] = [[], 0]
+                buf[0].append(line)
+                buf[1] += len(line)
+                total += len(line)
+                if buf[1] >= max_bytes:
+                    total -= buf[1]
+                    if not submit(dest): break
+                elif total >= max_buffered_bytes:
+                    largest = max(buffers, key=lambda d: buffers[d][1])
+                    total -= buffers[largest][1]
+                    if not submit(largest): break
+            else:
+                for dest in buffers.keys():
+                    if not submit(dest): break
+        finally:
+            posts.join()
+        receipts = collections.defaultdict(list)
+        for dest, receipt in posts.results:
+            receipts[dest].append(receipt)
+        receipts = dict((dest, _merge_receipts(r)) for dest, r in receipts.iteritems())
+        if posts.errors:
+            e = posts.errors[0][1]
+            e.receipts, e.errors = receipts, posts.errors
+            raise e
+        return receipts
+
+    def append_all_from_file(self, dest, format, src, parallel=1, chunk_size=8 * 1024 * 1024):
+        """
+Given a file and a format, append all the data from the file to the destination
+path. The ``format`` should be one of those provided by the ``precog.Format``
+class (e.g. ``Format.json``).
+
+With ``parallel`` greater than one, jsonstream (one value per line) and CSV
+data is split into chunks of about ``chunk_size`` bytes on record boundaries,
+and the chunks are sent over ``parallel`` concurrent connections. CSV chunks
+each repeat the header line. The returned receipt combines those of all the
+chunks.
+
+Arguments:
+ * dest (str): Precog path to append the object to.
  * format (dict): A dictionary defining the format to be used. See
    ``precog.Format`` for the supported formats.
  * src (str or file): Either a path (as a string) or a file object read from.
+
+Keyword Arguments:
+ * parallel (int): Number of chunks to send concurrently.
+ * chunk_size (int): Approximate size of each chunk, in bytes.
         """
-        if type(src) == str or type(src) == unicode:
-            f = open(src, 'r')
-            s = f.read()
-            f.close()
-        else:
-            s = src.read()
-        return self.append_all_from_string(dest, format, s)
+        return self._ingest_file(dest, format, src, parallel, chunk_size)
 
     def append_all_from_string(self, dest, format, src):
         """
@@ -242,7 +2051,7 @@ Arguments:
         """
         return self._ingest(dest, format, src, mode='batch', receipt='true')
 
-    def upload_file(self, dest, format, src):
+    def upload_file(self, dest, format, src, parallel=1, chunk_size=8 * 1024 * 1024):
         """
 Given a file and a format, append all the data from the file to the destination
 path. This will replace any data that previously existed.The ``format`` should
@@ -253,15 +2062,14 @@ Arguments:
  * format (dict): A dictionary defining the format to be used. See
    ``precog.Format`` for the supported formats.
  * src (str or file): Either a path (as a string) or a file object read from.
+
+Keyword Arguments:
+ * parallel (int): Number of chunks to send concurrently (see
+   ``append_all_from_file``).
+ * chunk_size (int): Approximate size of each chunk, in bytes.
         """
-        if type(src) == str or type(src) == unicode:
-            f = open(src, 'r')
-            s = f.read()
-            f.close()
-        else:
-            s = src.read()
         self.delete(dest)
-        return self._ingest(dest, format, src, mode='batch', receipt='true')
+        return self._ingest_file(dest, format, src, parallel, chunk_size)
 
     def upload_string(self, dest, format, src):
         """
@@ -278,9 +2086,45 @@ Arguments:
         self.delete(dest)
         return self._ingest(dest, format, src, mode='batch', receipt='true')
 
+    def _ingest_file(self, dest, format, src, parallel=1, chunk_size=None):
+        """
+Ingests a file (given as a path or file object) without reading it into
+memory: the contents are streamed to the server in ``CHUNK_SIZE`` blocks, or
+split into chunks sent in parallel.
+        """
+        if type(src) == str or type(src) == unicode:
+            f = open(src, 'rb')
+            try:
+                return self._ingest_file(dest, format, f, parallel, chunk_size)
+            finally:
+                f.close()
+        if parallel > 1:
+            return self._ingest_parallel(dest, format, src, parallel, chunk_size)
+        return self._ingest(dest, format, src, mode='batch', receipt='true')
+
+    def _ingest_parallel(self, dest, format, f, parallel, chunk_size):
+        if format['mime'] not in (Format.jsonstream['mime'], 'text/csv'):
+            raise PrecogClientError("parallel ingest needs jsonstream or csv data")
+        posts = _Posts(parallel)
+        try:
+            for chunk in _record_chunks(f, format, chunk_size):
+                if not posts.submit(None, self._ingest, dest, format, chunk, 'batch', 'true'):
+                    break
+        finally:
+            posts.join()
+        if posts.errors:
+            raise posts.errors[0][1]
+        if not posts.results:
+            raise PrecogClientError("no bytes to ingest")
+        return _merge_receipts([r for _, r in posts.results])
+
     def _ingest(self, path, format, bytes, mode, receipt):
-        """Ingests csv or json data at the specified path"""
-        if not bytes:
+        """
+Ingests csv or json data at the specified path. The data may be a string, a
+file object, or an iterable of strings. ``mode`` is 'batch' or 'streaming';
+with ``receipt='false'`` the result is None instead of a receipt.
+        """
+        if bytes is None or _body_length(bytes) == 0:
             raise PrecogClientError("no bytes to ingest")
 
         fullpath = ujoins('/ingest/v1/fs', self.basepath, path)
@@ -288,12 +2132,24 @@ Arguments:
         params.update(format['params'])
         headers = {'Content-Type': format['mime']}
 
-        return self._post(fullpath, bytes, params=params, headers=headers)
+        try:
+            # without a receipt the server only acknowledges the request
+            return self._doit('POST', fullpath, bytes, params, headers, void=receipt == 'false')
+        finally:
+            self._invalidate(path)
 
     def delete(self, path):
         params = {'apiKey': self.apikey}
         fullpath = ujoins('/ingest/v1/fs', self.basepath, path)
-        return self._delete(fullpath, params=params)
+        try:
+            return self._delete(fullpath, params=params)
+        finally:
+            self._invalidate(path)
+
+    def _invalidate(self, path):
+        """Drop cached query results that a write to ``path`` may change."""
+        if self.cache is not None:
+            self.cache.invalidate(ujoins(self.basepath, path))
 
     def query(self, query, path="", detailed=False):
         """
@@ -309,33 +2165,2138 @@ Keyword Arguments:
  * detailed (bool): If true, result will be a dictionary containing more
    information about how the query was performed.
         """
+        return self._query(query, path, detailed, self._query_args)
+
+    def _query(self, query, path, detailed, args):
+        """
+Run a query through the cache; ``args(query, path)`` returns the request path
+and parameters (see ``_query_args``) when the query has to be sent.
+        """
+        if self.cache is not None:
+            key = (self.host, self.basepath, path, query, detailed)
+            found, result = self.cache.get(key)
+            if found: return result
+        fullpath, params = args(query, path)
+        result = _query_result(self._get(fullpath, params=params), detailed)
+        if self.cache is not None:
+            self.cache.put(key, result, ujoins(self.basepath, path))
+        return result
+
+    def query_many(self, queries, concurrency=8, detailed=False):
+        """
+Evaluate many queries concurrently.
+
+Runs up to ``concurrency`` queries at a time over pooled connections and
+returns a list of ``QueryOutcome`` in the same order as ``queries``. A query
+which fails does not stop the others: its outcome has ``error`` set instead of
+``result``.
+
+Arguments:
+ * queries (list): Queries to run, each either a ``(query, path)`` tuple, a
+   query string (run against the base path), or a ``(PreparedQuery, values)``
+   tuple.
+
+Keyword Arguments:
+ * concurrency (int): Maximum number of queries running at once.
+ * detailed (bool): If true, results are detailed dictionaries (see ``query``).
+        """
+        outcomes = list(self.query_many_iter(queries, concurrency, detailed))
+        outcomes.sort(key=lambda o: o.index)
+        return outcomes
+
+    def query_many_iter(self, queries, concurrency=8, detailed=False):
+        """
+Like ``query_many``, but yields each ``QueryOutcome`` as soon as its query
+completes, so results can be processed while the other queries still run.
+        """
+        def run((i, q)):
+            if isinstance(q, basestring):
+                q = (q, "")
+            prepared = isinstance(q[0], PreparedQuery)
+            query, path = (q[0].query_template, q[0].path) if prepared else q
+            try:
+                if prepared:
+                    query = q[0].render(q[1])
+                    result = q[0].query(q[1], detailed)
+                else:
+                    result = self.query(query, path, detailed)
+                return QueryOutcome(i, query, path, result, None)
+            except Exception, e:
+                return QueryOutcome(i, query, path, None, e)
+        workers = ThreadPool(concurrency)
+        try:
+            for outcome in workers.imap_unordered(run, enumerate(queries)):
+                yield outcome
+        finally:
+            workers.terminate()
+
+    def query_to_file(self, query, dest, path="", format=Format.jsonstream, columns=None):
+        """
+Evaluate a query and write the resulting set to a file.
+
+The response is streamed and each row is re-encoded and written as it
+arrives, in blocks of about ``CHUNK_SIZE`` bytes, so the result set is never
+held in memory. With ``Format.jsonstream`` each row is written as one line of
+JSON; with ``Format.json`` the rows are written as one JSON array; and with a
+CSV format (``Format.csv``, ``Format.tsv``, ``Format.ssv`` or one made by
+``Format.makecsv``) each row becomes a line with one field per column. Nested
+values are written as JSON and None as an empty field. Rows that are not
+objects are written to a single ``value`` column.
+
+Returns a dictionary with the number of ``rows`` and ``bytes`` written and
+the ``elapsed`` time in seconds.
+
+Arguments:
+ * query (str): The Quirrel query to perform.
+ * dest (str or file): Either a path (as a string) or a file object to write to.
+   A file at the path is removed again if the query fails.
+
+Keyword Arguments:
+ * path (str): Optional base path to add for this query.
+ * format (dict): Output format (see ``precog.Format``).
+ * columns (list): CSV columns, in order (defaults to the sorted keys of the
+   first row). Keys missing from a row are left empty.
+        """
+        if type(dest) == str or type(dest) == unicode:
+            f = open(dest, 'wb')
+            try:
+                return self.query_to_file(query, f, path, format, columns)
+            except:
+                f.close()
+                os.remove(dest)
+                raise
+            finally:
+                f.close()
+        t0 = time.time()
+        rows, nbytes, pieces, size = 0, 0, [], 0
+        encode = _row_encoder(format, self.codec.dumps, columns)
+        with self.query_iter(query, path) as results:
+            for row in results:
+                for s in encode(row):
+                    pieces.append(s)
+                    size += len(s)
+                rows += 1
+                if size >= CHUNK_SIZE:
+                    dest.write(''.join(pieces))
+                    nbytes += size
+                    pieces, size = [], 0
+        for s in encode(None):
+            pieces.append(s)
+            size += len(s)
+        dest.write(''.join(pieces))
+        nbytes += size
+        return {'rows': rows, 'bytes': nbytes, 'elapsed': time.time() - t0}
+
+    def query_iter(self, query, path=""):
+        """
+Evaluate a query, streaming the results.
+
+Like ``query``, but returns a ``QueryResults`` iterator which decodes the
+resulting set one element at a time as the response arrives, instead of
+loading the whole result into memory first::
+
+    for row in client.query_iter("//mysongs"):
+        print row["song"]
+
+Arguments:
+ * query (str): The Quirrel query to perform.
+
+Keyword Arguments:
+ * path (str): Optional base path to add for this query.
+        """
+        fullpath, params = self._query_args(query, path)
+        return QueryResults(self._stream('GET', fullpath, '', params, {}))
+
+    def prepare(self, query, path=""):
+        """
+Prepare a query template to be run many times with different values::
+
+    q = client.prepare('count(load($path))')
+    counts = [q.query({'path': p}) for p in paths]
+
+Arguments:
+ * query (str): The Quirrel query, with ``$name`` placeholders (see
+   ``PreparedQuery``).
+
+Keyword Arguments:
+ * path (str): Optional base path to add for this query.
+        """
+        return PreparedQuery(self, query, path)
+
+    def _query_args(self, query, path):
         fullpath = ujoins('/analytics/v1/fs', self.basepath, path)
         params = {"q": query, 'apiKey': self.apikey, 'format': 'detailed'}
-        d = self._get(fullpath, params=params)
-        if detailed: return d
-        errors = d.get('errors', [])
-        if errors:
-            raise PrecogClientError("query had errors: %r" % errors)
-        servererrors = d.get('serverErrors', [])
-        if servererrors:
-            raise PrecogClientError("server had errors: %r" % errors)
-        for w in d.get('warnings', []):
+        return fullpath, params
+
+    def async_query(self, query, path="", detailed=False):
+        """
+Start a query job on the server and return without waiting for its result.
+
+The returned ``QueryJob`` is checked by a single background poller shared by
+all the jobs of all clients, with exponential backoff between checks, so many
+long-running queries can be in flight without a thread or open connection per
+query::
+
+    jobs = [client.async_query(q) for q in queries]
+    results = [job.result() for job in jobs]
+
+Arguments:
+ * query (str): The Quirrel query to perform.
+
+Keyword Arguments:
+ * path (str): Optional base path to add for this query.
+ * detailed (bool): If true, the job's result will be a dictionary containing
+   more information about how the query was performed.
+        """
+        basepath = ujoin(self.basepath, path)
+        params = {"q": query, 'apiKey': self.apikey, 'basePath': basepath}
+        d = self._post('/analytics/v1/queries', params=params)
+        if not isinstance(d, dict) or 'jobId' not in d:
+            raise PrecogServiceError("no job id in response %r" % d)
+        job = QueryJob(self, d['jobId'], detailed)
+        _jobs.add(job)
+        return job
+
+    def async_status(self, jobid):
+        """Return the server's status report for a query job."""
+        fullpath = '/analytics/v1/queries/%s/status' % jobid
+        return self._get(fullpath, params={'apiKey': self.apikey})
+
+    def async_results(self, jobid):
+        """
+Return the detailed results of a query job, or None if it is still running.
+        """
+        fullpath = '/analytics/v1/queries/%s' % jobid
+        params = {'apiKey': self.apikey}
+        url = self._url(fullpath, params)
+        def fetch(sample):
+            response, data = self._send('GET', url, '', {}, sample=sample)
+            if response.status == 202:
+                if sample is not None: sample['status'] = 202
+                return None
+            return self._response(url, '', params, {}, response.status, response.reason,
+                                  data, False, sample)
+        return self._limited(fullpath, lambda: self._measure('GET', fullpath, fetch))
+
+    def wait_until_visible(self, dest, expected_count, timeout=30.0, at_least=False):
+        """
+Wait until queries see exactly ``expected_count`` events at a path, for
+instance after appending events (using the counts from their receipts) or
+after deleting a path (with a count of 0)::
+
+    before = client.query("count(//mysongs)")[0]
+    receipt = client.append_all("mysongs", songs)
+    client.wait_until_visible("mysongs", before + receipt["ingested"])
+
+If other writers may append to the path meanwhile, pass ``at_least=True`` to
+accept any larger count too. An exact count is what tells that replaced data
+(for instance by ``upload_string``) is gone.
+
+The path is checked with exponential backoff and jitter by a background
+scheduler shared by all the waits, which counts every path of a client due for
+a check in a single query. Returns True once the count matches, or False if
+it still does not after ``timeout`` seconds.
+
+Arguments:
+ * dest (str): Precog path to count the events of (under the base path).
+ * expected_count (int): The number of events expected.
+
+Keyword Arguments:
+ * timeout (float): Maximum seconds to wait.
+ * at_least (bool): Also accept counts above ``expected_count``.
+        """
+        return _visibility.add(self, ujoin('/', dest), expected_count, timeout,
+                               at_least).result()
+
+
+def _query_result(d, detailed):
+    """Check a detailed query response for errors and extract its data."""
+    if detailed: return d
+    errors = d.get('errors', [])
+    if errors:
+        raise PrecogClientError("query had errors: %r" % errors)
+    servererrors = d.get('serverErrors', [])
+    if servererrors:
+        raise PrecogClientError("server had errors: %r" % servererrors)
+    for w in d.get('warnings', []):
+        sys.stderr.write("warning: %s" % w)
+    return d.get('data', None)
+
+class _ResponseStream(object):
+    """
+A response body being read incrementally (and decompressed if needed). The
+connection goes back to the pool once the body has been read to the end, or
+is closed if the stream is closed early. ``done(stream, error)``, if given, is
+called then.
+    """
+    def __init__(self, client, conn, response, done=None):
+        self.client   = client
+        self.conn     = conn
+        self.response = response
+        self.received = 0
+        self._done    = done
+        encoding = response.getheader('content-encoding')
+        if encoding in ('gzip', 'x-gzip', 'deflate'):
+            self._z = zlib.decompressobj(32 + zlib.MAX_WBITS if encoding != 'deflate' else zlib.MAX_WBITS)
+        elif encoding and encoding != 'identity':
+            conn.close()
+            raise PrecogServiceError("unsupported content encoding %r" % encoding)
+        else:
+            self._z = None
+
+    def read(self, n=CHUNK_SIZE):
+        """Return up to about ``n`` bytes of body, or '' at the end."""
+        while self.conn is not None:
+            try:
+                raw = self.response.read(n)
+            except Exception, e:
+                self.close(e)
+                raise
+            if not raw:
+                self.client._release(self.conn)
+                self.conn = None
+                self._finish()
+                return self._z.flush() if self._z else ''
+            self.received += len(raw)
+            if self._z is None:
+                return raw
+            try:
+                out = self._z.decompress(raw)
+            except zlib.error, e:
+                self.close(e)
+                raise PrecogServiceError("invalid compressed response: %s" % e)
+            if out:
+                return out
+        return ''
+
+    def close(self, error=None):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            self._finish(error)
+
+    def _finish(self, error=None):
+        done, self._done = self._done, None
+        if done is not None:
+            done(self, error)
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER_CHARS = re.compile(r'[0-9.eE+-]*')
+
+class _JsonReader(object):
+    """
+Reads JSON tokens and values incrementally from a ``read(n)`` function,
+holding only a small window of the input in memory.
+    """
+    decoder = json.JSONDecoder()
+
+    def __init__(self, read):
+        self._read = read
+        self.buf   = ''
+        self.pos   = 0
+        self.eof   = False
+
+    def _fill(self, n=CHUNK_SIZE):
+        data = self._read(n)
+        if data:
+            self.buf, self.pos = self.buf[self.pos:] + data, 0
+        else:
+            self.eof = True
+
+    def peek(self):
+        """Return the next non-whitespace character, or None at the end."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf): return self.buf[self.pos]
+            if self.eof: return None
+            self._fill()
+
+    def expect(self, chars):
+        c = self.peek()
+        if c is None or c not in chars:
+            raise PrecogServiceError("invalid json response: expected %r, got %r" % (chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decode the next complete JSON value."""
+        self.peek()
+        # each failed attempt decodes the value from its start again, so the
+        # reads grow geometrically to keep large values linear in their size
+        n = CHUNK_SIZE
+        while True:
+            try:
+                v, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise PrecogServiceError("invalid json response near %r" % self.buf[self.pos:self.pos + 40])
+                self._fill(n)
+                n *= 2
+                continue
+            # a number which may continue in the next block (its decoded part can
+            # end before the buffer does, as with "12." or "1e")
+            if (not self.eof and isinstance(v, (int, long, float)) and not isinstance(v, bool)
+                    and _NUMBER_CHARS.match(self.buf, end).end() == len(self.buf)):
+                self._fill(n)
+                n *= 2
+                continue
+            self.pos = end
+            return v
+
+def _csv_field(value, dumps):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (dict, list)):
+        return dumps(value)
+    return str(value) if not isinstance(value, float) else repr(value)
+
+class _Lines(list):
+    """A list which collects what a ``csv.writer`` writes to it."""
+    write = list.append
+
+def _row_encoder(format, dumps, columns=None):
+    """
+Return a function which turns each row of a query result into a list of
+strings in ``format``; it is called with None after the last row.
+    """
+    if format['mime'] == Format.jsonstream['mime']:
+        return lambda row: [] if row is None else [dumps(row), "\n"]
+    if format['mime'] == Format.json['mime']:
+        state = {'first': True}
+        def encode(row):
+            first, state['first'] = state['first'], False
+            if row is None:
+                return ["[]"] if first else ["]\n"]
+            return ["[" if first else ",\n", dumps(row)]
+        return encode
+    if format['mime'] != 'text/csv':
+        raise PrecogClientError("cannot write query results as %s" % format['mime'])
+    p = format['params']
+    out = _Lines()
+    if p['escape'] == p['quote']:
+        writer = csv.writer(out, delimiter=p['delim'], quotechar=p['quote'], lineterminator="\n")
+    else:
+        writer = csv.writer(out, delimiter=p['delim'], quotechar=p['quote'],
+                            escapechar=p['escape'], doublequote=False, lineterminator="\n")
+    state = {'columns': columns, 'header': False}
+    def encode(row):
+        del out[:]
+        if row is not None and not isinstance(row, dict):
+            row = {'value': row}
+        if state['columns'] is None and row is not None:
+            state['columns'] = sorted(row)
+        if not state['header'] and state['columns'] is not None:
+            writer.writerow([_csv_field(c, dumps) for c in state['columns']])
+            state['header'] = True
+        if row is not None:
+            writer.writerow([_csv_field(row.get(c), dumps) for c in state['columns']])
+        return out
+    return encode
+
+class QueryResults(object):
+    """
+Iterator over the rows of a query result, as returned by ``Precog.query_iter``.
+
+Rows are decoded one at a time while the response is read, so the full result
+set is never held in memory. The ``errors``, ``warnings``, ``serverErrors``
+and ``serverWarnings`` attributes are filled in as they are read; errors raise
+``PrecogClientError`` as soon as they are seen, and warnings are written to
+stderr at the end (like ``Precog.query``).
+
+Closing the iterator (or leaving a ``with`` block) before the end discards
+the rest of the response.
+    """
+    def __init__(self, stream):
+        self.errors         = []
+        self.warnings       = []
+        self.serverErrors   = []
+        self.serverWarnings = []
+        self._stream        = stream
+        self._rows          = self._parse(_JsonReader(stream.read))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self._rows.next()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._rows.close()
+        self._stream.close()
+
+    def _field(self, key, value):
+        if key in ('errors', 'warnings', 'serverErrors', 'serverWarnings'):
+            setattr(self, key, value)
+        if key == 'errors' and value:
+            raise PrecogClientError("query had errors: %r" % value)
+        if key == 'serverErrors' and value:
+            raise PrecogClientError("server had errors: %r" % value)
+
+    def _parse(self, r):
+        try:
+            r.expect('{')
+            if r.peek() == '}':
+                r.pos += 1
+            else:
+                while True:
+                    key = r.value()
+                    r.expect(':')
+                    if key == 'data' and r.peek() == '[':
+                        r.pos += 1
+                        if r.peek() == ']':
+                            r.pos += 1
+                        else:
+                            while True:
+                                yield r.value()
+                                if r.expect(',]') == ']': break
+                    elif key == 'data':
+                        yield r.value()
+                    else:
+                        self._field(key, r.value())
+                    if r.expect(',}') == '}': break
+            # make sure the connection can be reused
+            while self._stream.read(): pass
+        except:
+            self._stream.close()
+            raise
+        for w in self.warnings:
             sys.stderr.write("warning: %s" % w)
-        return d.get('data', None)
 
-    #def async_query(self, path, query):
-    #    basepath = ujoin(self.basepath, path)
-    #    params = {"q": query, 'apiKey': self.apikey, 'basePath': basepath}
-    #    return self.get('/analytics/v1/queries', params=params)
+class _PreparedParams(dict):
+    """Query parameters together with the request URL they were encoded into."""
+    url = None
+
+def _quirrel_literal(value):
+    """Render a Python value as a Quirrel literal."""
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, long)):
+        return str(value) if value >= 0 else "(%d)" % value
+    if isinstance(value, float):
+        if value != value or value in (float('inf'), float('-inf')):
+            raise PrecogClientError("cannot use %r in a query" % value)
+        return repr(value) if value >= 0 else "(%r)" % value
+    if isinstance(value, basestring):
+        return json.dumps(value)
+    if isinstance(value, (list, tuple)):
+        return "[%s]" % ", ".join(_quirrel_literal(v) for v in value)
+    raise PrecogClientError("cannot use %r in a query" % (value,))
+
+class PreparedQuery(object):
+    """
+A Quirrel query template which is parsed and encoded once, and then run many
+times with different values (see ``Precog.prepare``).
 
-    #def async_status(self, queryid):
-    #    fullpath = ujoins('/analytics/v1/queries/%d/status' % queryid)
-    #    return self.get(fullpath, params={'apiKey': self.apikey})
+Placeholders are written ``$name`` or ``${name}`` (``$$`` is a literal
+``$``). Each value is rendered as a Quirrel literal (a string, number,
+boolean, None as ``null``, or a list of those), so values can never change
+the structure of the query. The parts of the request which do not depend on
+the values are URL-encoded in advance.
 
-    #def async_results(self, queryid):
-    #    fullpath = '/analytics/v1/queries/%d' % queryid
-    #    return self.get(fullpath, params={'apiKey': self.apikey})
+Results are cached by the client's ``QueryCache`` just like those of
+``Precog.query``, and ``(prepared, values)`` pairs can be passed to
+``Precog.query_many``.
+
+Arguments:
+ * client (Precog): The client used to run the query.
+ * query (str): The Quirrel query template.
+
+Keyword Arguments:
+ * path (str): Optional base path to add for this query.
+    """
+    placeholder = re.compile(r'\$(?:(\$)|(\w+)|\{(\w+)\})')
+
+    def __init__(self, client, query, path=""):
+        self.client = client
+        self.query_template = query
+        self.path   = path
+        self.names  = set()
+        # literal text as (text, url-encoded text) pairs, and placeholder names
+        self._parts = []
+        text, i = [], 0
+        for m in self.placeholder.finditer(query):
+            text.append(query[i:m.start()])
+            i = m.end()
+            if m.group(1):
+                text.append('$')
+            else:
+                self._parts.append(self._literal(''.join(text)))
+                self._parts.append(m.group(2) or m.group(3))
+                self.names.add(m.group(2) or m.group(3))
+                text = []
+        text.append(query[i:])
+        self._parts.append(self._literal(''.join(text)))
+
+        self._fullpath, params = client._query_args('', path)
+        del params['q']
+        self._params = params
+        self._prefix = "%s?%s&q=" % (pathname2url(self._fullpath), urlencode(params.items()))
+
+    def __repr__(self):
+        return "PreparedQuery(%r, path=%r)" % (self.query_template, self.path)
+
+    @staticmethod
+    def _literal(text):
+        raw = text.encode('utf-8') if isinstance(text, unicode) else text
+        return (text, quote_plus(raw))
+
+    def _bind(self, values):
+        """Return the query text and its URL-encoded form for ``values``."""
+        missing = self.names.difference(values)
+        if missing:
+            raise PrecogClientError("no value for $%s" % ", $".join(sorted(missing)))
+        unknown = set(values).difference(self.names)
+        if unknown:
+            raise PrecogClientError("unknown parameter %s" % ", ".join(sorted(unknown)))
+        text, encoded = [], []
+        for part in self._parts:
+            if isinstance(part, tuple):
+                text.append(part[0])
+                encoded.append(part[1])
+            else:
+                literal = _quirrel_literal(values[part])
+                text.append(literal)
+                encoded.append(quote_plus(literal))
+        return ''.join(text), ''.join(encoded)
+
+    def _args(self, encoded):
+        """Return a request-arguments function (see ``Precog._query``)."""
+        def args(query, path):
+            params = _PreparedParams(self._params, q=query)
+            params.url = self._prefix + encoded
+            return self._fullpath, params
+        return args
+
+    def render(self, values={}):
+        """Return the query text with ``values`` substituted."""
+        return self._bind(values)[0]
+
+    def query(self, values={}, detailed=False):
+        """
+Run the query with the given values (see ``Precog.query``).
+
+Arguments:
+ * values (dict): A value for each placeholder, by name.
+
+Keyword Arguments:
+ * detailed (bool): If true, result will be a dictionary containing more
+   information about how the query was performed.
+        """
+        text, encoded = self._bind(values)
+        return self.client._query(text, self.path, detailed, self._args(encoded))
+
+    def query_iter(self, values={}):
+        """Run the query with the given values, streaming the results (see ``Precog.query_iter``)."""
+        text, encoded = self._bind(values)
+        fullpath, params = self._args(encoded)(text, self.path)
+        return QueryResults(self.client._stream('GET', fullpath, '', params, {}))
+
+class QueryOutcome(collections.namedtuple('QueryOutcome', 'index query path result error')):
+    """
+The outcome of one query run by ``Precog.query_many``: ``index`` is its
+position in the input, and either ``result`` holds its result or ``error``
+the exception it raised.
+    """
+    __slots__ = ()
+
+class QueryJob(object):
+    """
+A query running on the server, as returned by ``Precog.async_query``.
+
+Attributes:
+ * jobid (str): The server's identifier for the job.
+    """
+    def __init__(self, client, jobid, detailed=False):
+        self.client   = client
+        self.jobid    = jobid
+        self.detailed = detailed
+        self._future  = Future()
+
+    def done(self):
+        """Return True once the job's result (or error) has been received."""
+        return self._future.done()
+
+    def wait(self, timeout=None):
+        """Wait up to ``timeout`` seconds for the job; returns ``done()``."""
+        return self._future.wait(timeout)
+
+    def result(self, timeout=None):
+        """
+Wait for the job and return its result, as ``Precog.query`` would. Raises
+``PrecogClientError`` if the job is not done within ``timeout`` seconds.
+        """
+        return self._future.result(timeout)
+
+    def status(self):
+        """Ask the server for the job's current status."""
+        return self.client.async_status(self.jobid)
+
+class _Scheduler(object):
+    """
+Base class for background checks of outstanding requests. Entries are kept in
+a heap by due time, and a daemon thread removes those which are due
+(``_take``) and checks them (``_check``), which may schedule them again. One
+scheduler of each kind serves every client; its thread only runs while entries
+are pending, so it holds no client once their requests are done.
+    """
+    name = 'precog-scheduler'
+
+    def __init__(self):
+        self._entries = []
+        self._seq     = 0
+        self._cond    = threading.Condition()
+        self._thread  = None
+
+    def _push(self, due, entry):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._entries, (due, self._seq, entry))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def _take(self, now):
+        """Remove and return the entries to check at ``now`` (the lock is held)."""
+        return [heapq.heappop(self._entries)[2]]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._entries and self._entries[0][0] > time.time():
+                    self._cond.wait(self._entries[0][0] - time.time())
+                if not self._entries:
+                    self._thread = None
+                    return
+                batch = self._take(time.time())
+            self._check(batch)
+
+class _JobPoller(_Scheduler):
+    """
+Checks outstanding query jobs. Each job is checked after ``min_interval``
+seconds, then at intervals growing by ``backoff`` up to ``max_interval``.
+    """
+    name         = 'precog-jobs'
+    min_interval = 0.1
+    max_interval = 5.0
+    backoff      = 1.5
+
+    def add(self, job, interval=None):
+        interval = self.min_interval if interval is None else interval
+        self._push(time.time() + interval, (job, interval))
+
+    def _check(self, batch):
+        for job, interval in batch:
+            try:
+                d = job.client.async_results(job.jobid)
+                if d is None:
+                    self.add(job, min(interval * self.backoff, self.max_interval))
+                    continue
+                job._future.set_result(_query_result(d, job.detailed))
+            except Exception, e:
+                job._future.set_exception(e, sys.exc_info()[2])
+
+_jobs = _JobPoller()
+
+class _VisibilityWaiter(_Scheduler):
+    """
+Checks when ingested data becomes visible to queries, for
+``Precog.wait_until_visible``. The counts of all the paths of a client due to
+be checked are fetched together with a single query. Each wait is checked
+after ``min_interval`` seconds, then at intervals growing by ``backoff`` up to
+``max_interval``, with random ``jitter`` so that waits started together spread
+out; waits due within half their interval are checked early to share a query.
+    """
+    name         = 'precog-visibility'
+    min_interval = 0.1
+    max_interval = 5.0
+    backoff      = 1.5
+    jitter       = 0.2
 
+    def add(self, client, path, expected, timeout, at_least=False):
+        """Start waiting for ``path`` to count ``expected`` events; returns a ``Future``."""
+        wait = {'client': client, 'path': path, 'expected': expected, 'at_least': at_least,
+                'deadline': time.time() + timeout, 'interval': self.min_interval,
+                'future': Future()}
+        self._schedule(wait)
+        return wait['future']
+
+    def _schedule(self, wait):
+        delay = wait['interval'] * random.uniform(1 - self.jitter, 1 + self.jitter)
+        self._push(min(time.time() + delay, wait['deadline']), wait)
+
+    def _take(self, now):
+        batch = []
+        while self._entries and self._entries[0][0] <= now + self._entries[0][2]['interval'] / 2:
+            batch.append(heapq.heappop(self._entries)[2])
+        return batch
+
+    def _check(self, batch):
+        byclient = collections.defaultdict(list)
+        for w in batch:
+            byclient[w['client']].append(w)
+        for client, waits in byclient.iteritems():
+            self._check_client(client, waits)
+
+    def _check_client(self, client, waits):
+        paths = sorted(set(w['path'] for w in waits))
+        try:
+            counts = dict(zip(paths, self._counts(client, paths)))
+        except Exception, e:
+            log.warning("visibility check failed: %s", e)
+            counts = {}
+        now = time.time()
+        for w in waits:
+            count = counts.get(w['path'])
+            if count == w['expected'] or (w['at_least'] and count > w['expected']):
+                w['future'].set_result(True)
+            elif now >= w['deadline']:
+                w['future'].set_result(False)
+            else:
+                w['interval'] = min(w['interval'] * self.backoff, self.max_interval)
+                self._schedule(w)
+
+    def _counts(self, client, paths):
+        """Count the events at each path, in one query (bypassing any cache)."""
+        counts = ", ".join("count(load(%s))" % json.dumps(p) for p in paths)
+        query = counts if len(paths) == 1 else "[%s]" % counts
+        fullpath, params = client._query_args(query, "")
+        d = client._get(fullpath, params=params)
+        if isinstance(d, Future):
+            d = d.result()
+        data = _query_result(d, False)
+        return data if len(paths) == 1 else data[0]
+
+_visibility = _VisibilityWaiter()
+
+class BatchingIngester(object):
+    """
+Collects single events and ingests them in batches.
+
+Events added with ``add`` are grouped by destination path and posted in the
+background (as ``Format.jsonstream``) once a destination has buffered
+``max_bytes`` bytes or ``max_events`` events, or its oldest event has waited
+``max_latency`` seconds. ``add`` may be called from many threads; when more
+than ``max_pending_bytes`` are buffered or in flight it blocks until the
+background thread has caught up.
+
+Call ``flush`` to wait until everything added so far has been posted, and
+``close`` (or use the ingester as a context manager) when done.
+
+Arguments:
+ * client (Precog): The client used to post batches.
+
+Keyword Arguments:
+ * max_bytes (int): Flush a destination once its batch reaches this size.
+ * max_events (int): Flush a destination once its batch has this many events.
+ * max_latency (float): Maximum seconds an event is buffered before flushing.
+ * max_pending_bytes (int): Bytes buffered or in flight before ``add`` blocks.
+ * callback (function): Called as ``callback(dest, receipt, error)`` after each
+   batch is posted; ``error`` is None on success. Errors are logged otherwise.
+    """
+    def __init__(self, client, max_bytes=1024 * 1024, max_events=10000,
+                 max_latency=1.0, max_pending_bytes=16 * 1024 * 1024, callback=None):
+        self.client            = client
+        self.max_bytes         = max_bytes
+        self.max_events        = max_events
+        self.max_latency       = max_latency
+        self.max_pending_bytes = max_pending_bytes
+        self.callback          = callback
+        self.batches           = 0
+        self.events            = 0
+        self.failures          = 0
+        self._buffers          = {}
+        self._pending          = 0
+        self._flushing         = False
+        self._closed           = False
+        self._cond             = threading.Condition()
+        self._thread           = threading.Thread(target=self._run, name='precog-batcher')
+        self._thread.daemon    = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, dest, obj):
+        """
+Buffer a single JSON value (a Python dictionary, list, number, string, boolean
+or None) to be appended to ``dest``.
+        """
+        line = self.client.codec.dumps(obj) + "\n"
+        n = len(line)
+        with self._cond:
+            while self._pending and self._pending + n > self.max_pending_bytes and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                raise PrecogClientError("ingester is closed")
+            buf = self._buffers.get(dest)
+            if buf is None:
+                # wake the background thread so it can schedule this batch
+                buf = self._buffers[dest] = [[], 0, time.time()]
+                self._cond.notify_all()
+            buf[0].append(line)
+            buf[1] += n
+            self._pending += n
+            if buf[1] >= self.max_bytes or len(buf[0]) >= self.max_events:
+                self._cond.notify_all()
+
+    def flush(self):
+        """Block until every event added so far has been posted."""
+        with self._cond:
+            self._flushing = True
+            self._cond.notify_all()
+            while self._pending:
+                self._cond.wait()
+            self._flushing = False
+
+    def close(self):
+        """Flush remaining events and stop the background thread."""
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _ready(self, now):
+        """Pop the batches that are due; returns (ready, seconds until next)."""
+        ready, wait = [], None
+        for dest, buf in self._buffers.items():
+            due = buf[2] + self.max_latency
+            if (self._flushing or self._closed or now >= due or
+                buf[1] >= self.max_bytes or len(buf[0]) >= self.max_events):
+                ready.append((dest, buf))
+                del self._buffers[dest]
+            elif wait is None or due - now < wait:
+                wait = due - now
+        return ready, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    ready, wait = self._ready(time.time())
+                    if ready: break
+                    if self._closed: return
+                    self._cond.wait(wait)
+            for dest, (lines, n, t) in ready:
+                self._post(dest, lines)
+                with self._cond:
+                    self._pending -= n
+                    self._cond.notify_all()
+
+    def _post(self, dest, lines):
+        receipt, error = None, None
+        try:
+            receipt = self.client._ingest(dest, Format.jsonstream, ''.join(lines),
+                                          mode='batch', receipt='true')
+            # the batch stays pending until an AsyncPrecog client has posted it
+            if isinstance(receipt, Future):
+                receipt = receipt.result()
+            self.batches += 1
+            self.events += len(lines)
+        except Exception, e:
+            self.failures += 1
+            error = e
+        if self.callback is not None:
+            try:
+                self.callback(dest, receipt, error)
+            except Exception:
+                log.exception("ingest callback failed")
+        elif error is not None:
+            log.error("failed to ingest %d events to %r: %s", len(lines), dest, error)
+
+class StreamingIngester(object):
+    """
+Ingests data without waiting for the server to ingest each request.
+
+``append``, ``append_all`` and ``append_all_from_string`` return a ``Future``
+straight away, and the data is posted in the background in ``streaming``
+mode by up to ``max_in_flight`` concurrent requests, so producers are not
+held up by server-side ingest latency. They only block once
+``max_in_flight`` requests are running and as many again are waiting.
+
+By default no receipts are requested: the server acknowledges each request
+without reporting how many events it ingested, and the futures result in
+None. With ``receipts=True`` the futures result in the receipt of each
+request, collected as the responses arrive.
+
+Call ``flush`` to wait until every request so far has been answered, and
+``close`` (or use the ingester as a context manager) when done.
+
+Arguments:
+ * client (Precog): The client used to post data.
+
+Keyword Arguments:
+ * max_in_flight (int): Number of concurrent requests (defaults to the size of
+   the client's connection pool).
+ * receipts (bool): Whether to request an ingest receipt for each request.
+ * callback (function): Called as ``callback(dest, receipt, error)`` after each
+   request; ``error`` is None on success. Errors are logged otherwise.
+    """
+    def __init__(self, client, max_in_flight=None, receipts=False, callback=None):
+        if max_in_flight is None:
+            max_in_flight = max(1, client.pool.size)
+        self.client        = client
+        self.max_in_flight = max_in_flight
+        self.receipts      = receipts
+        self.callback      = callback
+        self.requests      = 0
+        self.failures      = 0
+        self._pending      = 0
+        self._closed       = False
+        self._cond         = threading.Condition()
+        self._slots        = threading.Semaphore(max_in_flight * 2)
+        self._workers      = ThreadPool(max_in_flight)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, dest, obj):
+        """Append a single JSON value to ``dest``; returns a ``Future``."""
+        return self._submit(dest, Format.jsonstream, self.client.codec.dumps(obj))
+
+    def append_all(self, dest, objs):
+        """
+Append a list of JSON values to ``dest``; returns a ``Future``. Any other
+iterable is serialized as jsonstream while it is sent.
+        """
+        if not isinstance(objs, (list, tuple, dict)) and hasattr(objs, '__iter__'):
+            body = _JsonStreamBody(objs, 0, self.client.codec.dumps)
+            return self._submit(dest, Format.jsonstream, body)
+        return self._submit(dest, Format.json, self.client.codec.dumps(objs))
+
+    def append_all_from_string(self, dest, format, src):
+        """Append data in ``format`` from a string to ``dest``; returns a ``Future``."""
+        return self._submit(dest, format, src)
+
+    def flush(self):
+        """Block until every request made so far has been answered."""
+        with self._cond:
+            while self._pending:
+                self._cond.wait()
+
+    def close(self):
+        """Wait for the remaining requests and stop the background threads."""
+        with self._cond:
+            self._closed = True
+        self.flush()
+        self._workers.close()
+        self._workers.join()
+
+    def _submit(self, dest, format, body):
+        with self._cond:
+            if self._closed:
+                raise PrecogClientError("ingester is closed")
+            self._pending += 1
+        self._slots.acquire()
+        future = Future()
+        self._workers.apply_async(self._post, (dest, format, body, future))
+        return future
+
+    def _post(self, dest, format, body, future):
+        receipt, error, tb = None, None, None
+        try:
+            receipt = self.client._ingest(dest, format, body, mode='streaming',
+                                          receipt='true' if self.receipts else 'false')
+            if isinstance(receipt, Future):
+                receipt = receipt.result()
+            self.requests += 1
+        except Exception, e:
+            self.failures += 1
+            error, tb = e, sys.exc_info()[2]
+        self._slots.release()
+        if self.callback is not None:
+            try:
+                self.callback(dest, receipt, error)
+            except Exception:
+                log.exception("ingest callback failed")
+        elif error is not None:
+            log.error("failed to ingest to %r: %s", dest, error)
+        if error is None:
+            future.set_result(receipt)
+        else:
+            future.set_exception(error, tb)
+        with self._cond:
+            self._pending -= 1
+            self._cond.notify_all()
+
+_SEGMENT_RE = re.compile(r'^(\d{20})-([A-Za-z0-9_=-]*)\.(open|seg)$')
+
+class _Segment(object):
+    """A spool segment file being written for one destination path."""
+    def __init__(self, seq, dest, path):
+        self.seq    = seq
+        self.dest   = dest
+        self.path   = path
+        self.fd     = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+        self.size   = 0
+        self.opened = time.time()
+        self.synced = self.opened
+
+def _complete_length(path):
+    """Return the length of a spool file up to the end of its last complete line."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        while end > 0:
+            start = max(0, end - CHUNK_SIZE)
+            f.seek(start)
+            i = f.read(end - start).rfind("\n")
+            if i >= 0:
+                return start + i + 1
+            end = start
+    return 0
+
+def _rejected(error):
+    """True if retrying the request which raised ``error`` cannot succeed."""
+    status = getattr(error, 'status', None)
+    return isinstance(error, PrecogClientError) or (
+        status is not None and 400 <= status < 500 and status != 429)
+
+class Spool(object):
+    """
+Durable local spool for events to be ingested.
+
+Events added with ``add`` or ``add_all`` are appended straight to segment
+files in ``directory`` (one per destination path), so producers only ever
+wait for the local disk. A background thread closes each segment once it
+reaches ``segment_bytes`` bytes or ``max_latency`` seconds, posts it (as
+``Format.jsonstream``), and deletes it once the receipt has arrived. Failed
+posts are retried with exponential backoff, and later segments wait behind
+the failing one so events arrive in order.
+
+Segments left over by a previous run (for instance after a crash) are posted
+when a spool is opened on the same directory; a partly written last event is
+discarded. Delivery is at least once: a segment whose receipt was lost is
+posted again.
+
+``fsync`` controls when data is forced to disk: 'always' after every add,
+'interval' at most every ``fsync_interval`` seconds and when a segment is
+closed, or 'never'. Events survive a crash of the process in every case, and
+a crash of the machine unless ``fsync`` is 'never'.
+
+Call ``flush`` to wait until everything added so far has been posted, and
+``close`` (or use the spool as a context manager) when done.
+
+Arguments:
+ * client (Precog): The client used to post segments.
+ * directory (str): Directory holding the segment files; created if needed.
+
+Keyword Arguments:
+ * segment_bytes (int): Close a segment once it reaches this size.
+ * max_latency (float): Maximum seconds a segment is written to before it is
+   closed and posted.
+ * fsync (str): 'always', 'interval' or 'never' (see above).
+ * fsync_interval (float): Seconds between syncs with ``fsync='interval'``.
+ * retry_delay (float): Seconds before the first retry of a failed post.
+ * max_retry_delay (float): Maximum seconds between retries.
+ * max_retries (int): Retries before a segment is set aside by renaming it to
+   ``*.failed`` (defaults to None, retrying forever). A segment the server
+   rejects as invalid (a 4xx status other than 429) is set aside at once.
+ * callback (function): Called as ``callback(dest, receipt, error)`` after each
+   post; ``error`` is None on success. Errors are logged otherwise.
+    """
+    def __init__(self, client, directory, segment_bytes=8 * 1024 * 1024, max_latency=1.0,
+                 fsync='interval', fsync_interval=1.0, retry_delay=1.0, max_retry_delay=60.0,
+                 max_retries=None, callback=None):
+        if fsync not in ('always', 'interval', 'never'):
+            raise PrecogClientError("unsupported fsync policy %r" % fsync)
+        self.client          = client
+        self.directory       = directory
+        self.segment_bytes   = segment_bytes
+        self.max_latency     = max_latency
+        self.fsync           = fsync
+        self.fsync_interval  = fsync_interval
+        self.retry_delay     = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_retries     = max_retries
+        self.callback        = callback
+        self.spooled         = 0
+        self.segments        = 0
+        self.events          = 0
+        self.failures        = 0
+        self._open           = {}
+        self._sealed         = []
+        self._failed         = []
+        self._seq            = 0
+        self._retries        = 0
+        self._retry_at       = 0
+        self._closed         = False
+        self._cond           = threading.Condition()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._recover()
+        self._thread         = threading.Thread(target=self._run, name='precog-spool')
+        self._thread.daemon  = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, dest, obj):
+        """
+Spool a single JSON value (a Python dictionary, list, number, string, boolean
+or None) to be appended to ``dest``.
+        """
+        self._write(dest, self.client.codec.dumps(obj) + "\n", 1)
+
+    def add_all(self, dest, objs):
+        """Spool each JSON value of ``objs`` to be appended to ``dest``."""
+        dumps = self.client.codec.dumps
+        lines = [dumps(obj) + "\n" for obj in objs]
+        if lines:
+            self._write(dest, "".join(lines), len(lines))
+
+    def flush(self, timeout=None):
+        """
+Block until every event added so far has been posted, or until ``timeout``
+seconds have passed. Returns True if everything was posted, and False on a
+timeout or if a segment waited for was set aside as ``*.failed``.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            for dest in self._open.keys():
+                self._seal(dest)
+            mark = self._seq
+            failed = len(self._failed)
+            self._cond.notify_all()
+            while self._sealed and self._sealed[0][0] < mark:
+                if deadline is None:
+                    self._cond.wait()
+                elif time.time() >= deadline:
+                    return False
+                else:
+                    self._cond.wait(deadline - time.time())
+            return all(seq >= mark for seq in self._failed[failed:])
+
+    def close(self, timeout=None):
+        """
+Post the remaining events (waiting at most ``timeout`` seconds) and stop the
+background thread. Events not posted by then stay on disk for the next spool
+opened on this directory.
+        """
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def stats(self):
+        """Return counters, and the number of segments and bytes not yet posted."""
+        with self._cond:
+            pending = [s.size for s in self._open.itervalues()]
+            pending.extend(os.path.getsize(s[2]) for s in self._sealed)
+            return {'spooled': self.spooled, 'segments': self.segments, 'events': self.events,
+                    'failures': self.failures, 'pending_segments': len(pending),
+                    'pending_bytes': sum(pending)}
+
+    def _write(self, dest, data, count):
+        with self._cond:
+            if self._closed:
+                raise PrecogClientError("spool is closed")
+            seg = self._open.get(dest)
+            if seg is None:
+                seg = self._open[dest] = self._create(dest)
+                # wake the background thread so it can schedule this segment
+                self._cond.notify_all()
+            n = 0
+            while n < len(data):
+                n += os.write(seg.fd, buffer(data, n))
+            seg.size += len(data)
+            self.spooled += count
+            if self.fsync == 'always':
+                os.fsync(seg.fd)
+            elif self.fsync == 'interval' and time.time() - seg.synced >= self.fsync_interval:
+                os.fsync(seg.fd)
+                seg.synced = time.time()
+            if seg.size >= self.segment_bytes:
+                self._seal(dest)
+                self._cond.notify_all()
+
+    def _filename(self, seq, dest, state):
+        if isinstance(dest, unicode):
+            dest = dest.encode('utf-8')
+        name = "%020d-%s.%s" % (seq, urlsafe_b64encode(dest), state)
+        return os.path.join(self.directory, name)
+
+    def _create(self, dest):
+        seq, self._seq = self._seq, self._seq + 1
+        return _Segment(seq, dest, self._filename(seq, dest, 'open'))
+
+    def _seal(self, dest):
+        """Close the open segment for ``dest`` and queue it to be posted."""
+        seg = self._open.pop(dest)
+        if self.fsync != 'never':
+            os.fsync(seg.fd)
+        os.close(seg.fd)
+        path = self._filename(seg.seq, dest, 'seg')
+        os.rename(seg.path, path)
+        self._sealed.append((seg.seq, dest, path))
+
+    def _recover(self):
+        """Queue the segments left in the directory by an earlier spool."""
+        for name in sorted(os.listdir(self.directory)):
+            m = _SEGMENT_RE.match(name)
+            if not m: continue
+            seq, dest = int(m.group(1)), urlsafe_b64decode(m.group(2))
+            path = os.path.join(self.directory, name)
+            self._seq = max(self._seq, seq + 1)
+            if m.group(3) == 'open':
+                # the writer died: drop a partly written last event
+                n = _complete_length(path)
+                with open(path, 'r+b') as f:
+                    f.truncate(n)
+                if n == 0:
+                    os.remove(path)
+                    continue
+                os.rename(path, self._filename(seq, dest, 'seg'))
+                path = self._filename(seq, dest, 'seg')
+            self._sealed.append((seq, dest, path))
+        self._sealed.sort()
+
+    def _next(self, now):
+        """Close segments that are due; returns (segment to post, seconds until next)."""
+        wait = None
+        for dest, seg in self._open.items():
+            due = seg.opened + self.max_latency
+            if now >= due:
+                self._seal(dest)
+            elif wait is None or due - now < wait:
+                wait = due - now
+        if self._sealed:
+            if now >= self._retry_at:
+                return self._sealed[0], None
+            if wait is None or self._retry_at - now < wait:
+                wait = self._retry_at - now
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    segment, wait = self._next(time.time())
+                    if self._closed: return
+                    if segment is not None: break
+                    self._cond.wait(wait)
+            receipt, error = self._post(*segment)
+            with self._cond:
+                # the segment leaves _sealed before its file goes, so stats() never sees it missing
+                if error is None:
+                    self._sealed.pop(0)
+                    os.remove(segment[2])
+                    self.segments += 1
+                    self.events += receipt.get('ingested', 0)
+                    self._retries = 0
+                    self._retry_at = 0
+                elif _rejected(error) or (self.max_retries is not None and
+                                          self._retries >= self.max_retries):
+                    log.error("giving up on spool segment %s: %s", segment[2], error)
+                    self._sealed.pop(0)
+                    self._failed.append(segment[0])
+                    os.rename(segment[2], segment[2][:-len('seg')] + 'failed')
+                    self.failures += 1
+                    self._retries = 0
+                    self._retry_at = 0
+                else:
+                    delay = min(self.retry_delay * 2 ** self._retries, self.max_retry_delay)
+                    self.failures += 1
+                    self._retries += 1
+                    self._retry_at = time.time() + delay
+                self._cond.notify_all()
+
+    def _post(self, seq, dest, path):
+        """Post a segment; returns ``(receipt, error)``."""
+        receipt, error = None, None
+        try:
+            with open(path, 'rb') as f:
+                receipt = self.client._ingest(dest, Format.jsonstream, f,
+                                              mode='batch', receipt='true')
+                # an AsyncPrecog client reads the file after _ingest returns
+                if isinstance(receipt, Future):
+                    receipt = receipt.result()
+        except Exception, e:
+            error = e
+        if self.callback is not None:
+            try:
+                self.callback(dest, receipt, error)
+            except Exception:
+                log.exception("ingest callback failed")
+        elif error is not None:
+            log.error("failed to ingest spool segment %s to %r: %s", path, dest, error)
+        return receipt, error
+
+class Future(object):
+    """
+The eventual result of an asynchronous operation.
+
+``result`` blocks until the operation has finished and then returns its value
+(or raises its error). ``add_done_callback`` registers a function to be called
+with the future once it is done, and ``then`` chains a further computation on
+the result, returning a new future.
+    """
+    def __init__(self):
+        self._cond      = threading.Condition()
+        self._done      = False
+        self._result    = None
+        self._exc_info  = None
+        self._callbacks = []
+
+    def done(self):
+        """Return True if the operation has finished."""
+        return self._done
+
+    def wait(self, timeout=None):
+        """Wait until the operation has finished; returns ``done()``."""
+        with self._cond:
+            if not self._done:
+                self._cond.wait(timeout)
+            return self._done
+
+    def result(self, timeout=None):
+        """
+Return the result of the operation, waiting up to ``timeout`` seconds (or
+forever if None). Raises the operation's error if it failed, and
+``PrecogClientError`` if it has not finished in time.
+        """
+        if not self.wait(timeout):
+            raise PrecogClientError("timed out after %ss" % timeout)
+        if self._exc_info is not None:
+            t, v, tb = self._exc_info
+            raise t, v, tb
+        return self._result
+
+    def exception(self, timeout=None):
+        """Return the error the operation failed with, or None."""
+        if not self.wait(timeout):
+            raise PrecogClientError("timed out after %ss" % timeout)
+        return self._exc_info[1] if self._exc_info else None
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, e, tb=None):
+        self._finish(None, (type(e), e, tb))
+
+    def _finish(self, result, exc_info):
+        with self._cond:
+            if self._done:
+                return
+            self._result, self._exc_info, self._done = result, exc_info, True
+            callbacks, self._callbacks = self._callbacks, []
+            self._cond.notify_all()
+        for fn in callbacks:
+            _run_callback(fn, self)
+
+    def add_done_callback(self, fn):
+        """Call ``fn(future)`` once the operation has finished."""
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        _run_callback(fn, self)
+
+    def then(self, fn):
+        """
+Return a future for ``fn(result)``. If ``fn`` itself returns a future, the
+returned future completes with that future's outcome. Errors propagate without
+calling ``fn``.
+        """
+        out = Future()
+        def done(f):
+            if f._exc_info is not None:
+                out._finish(None, f._exc_info)
+                return
+            try:
+                r = fn(f._result)
+            except Exception, e:
+                out.set_exception(e, sys.exc_info()[2])
+                return
+            if isinstance(r, Future):
+                r.add_done_callback(lambda g: out._finish(g._result, g._exc_info))
+            else:
+                out.set_result(r)
+        self.add_done_callback(done)
+        return out
+
+def _run_callback(fn, arg):
+    try:
+        fn(arg)
+    except Exception:
+        log.exception("callback %r failed", fn)
+
+class EventLoop(object):
+    """
+A small single-threaded event loop driving non-blocking sockets.
+
+``AsyncPrecog`` clients run all their I/O on an EventLoop, so any number of
+concurrent requests are handled by one thread. By default all clients share
+the loop returned by ``EventLoop.default()``, which runs in a daemon thread.
+``call_soon`` and ``call_later`` may be used from any thread.
+    """
+    _default      = None
+    _default_lock = threading.Lock()
+
+    def __init__(self):
+        self._handlers = {}
+        self._timers   = []
+        self._ready    = collections.deque()
+        self._lock     = threading.Lock()
+        self._seq      = 0
+        self._thread   = None
+        self._running  = False
+        self._poll     = select.poll() if hasattr(select, 'poll') else None
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.watch(self._wake_r, self._drain_wakeup, None)
+
+    @classmethod
+    def default(cls):
+        """Return the shared loop, starting it on first use."""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+                cls._default.start()
+            return cls._default
+
+    def start(self):
+        """Run the loop in a new daemon thread."""
+        self._thread = threading.Thread(target=self.run, name='precog-loop')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Ask the loop to stop after the current iteration."""
+        self.call_soon(setattr, self, '_running', False)
+
+    def in_loop(self):
+        return threading.current_thread() is self._thread
+
+    def call_soon(self, fn, *args):
+        """Schedule ``fn(*args)`` on the loop thread."""
+        with self._lock:
+            self._ready.append((fn, args))
+        if not self.in_loop():
+            self._wakeup()
+
+    def call_later(self, delay, fn, *args):
+        """
+Schedule ``fn(*args)`` to run after ``delay`` seconds. Returns a handle which
+may be passed to ``cancel``.
+        """
+        with self._lock:
+            self._seq += 1
+            timer = [time.time() + delay, self._seq, fn, args]
+            heapq.heappush(self._timers, timer)
+        if not self.in_loop():
+            self._wakeup()
+        return timer
+
+    def cancel(self, timer):
+        timer[2] = None
+
+    def watch(self, fd, reader, writer):
+        """
+Call ``reader()`` when ``fd`` is readable and ``writer()`` when it is
+writable (either may be None). Must be called on the loop thread.
+        """
+        self._handlers[fd] = (reader, writer)
+        if self._poll is not None:
+            mask = (select.POLLIN if reader else 0) | (select.POLLOUT if writer else 0)
+            self._poll.register(fd, mask)
+
+    def unwatch(self, fd):
+        if self._handlers.pop(fd, None) is not None and self._poll is not None:
+            self._poll.unregister(fd)
+
+    def _wakeup(self):
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError:
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wake_r, 4096): pass
+        except OSError:
+            pass
+
+    def _wait(self, timeout):
+        """Return a list of (fd, readable, writable) events."""
+        if self._poll is not None:
+            ms = None if timeout is None else int(timeout * 1000)
+            try:
+                events = self._poll.poll(ms)
+            except select.error:
+                return []
+            err = select.POLLERR | select.POLLHUP | select.POLLNVAL
+            return [(fd, ev & (select.POLLIN | err), ev & (select.POLLOUT | err))
+                    for fd, ev in events]
+        rs = [fd for fd, (r, w) in self._handlers.items() if r]
+        ws = [fd for fd, (r, w) in self._handlers.items() if w]
+        try:
+            r, w, _ = select.select(rs, ws, [], timeout)
+        except select.error:
+            return []
+        return [(fd, fd in r, fd in w) for fd in set(r) | set(w)]
+
+    def run(self):
+        """Run the loop in the current thread until ``stop`` is called."""
+        self._thread = threading.current_thread()
+        self._running = True
+        while self._running:
+            with self._lock:
+                ready, self._ready = self._ready, collections.deque()
+                now = time.time()
+                while self._timers and self._timers[0][0] <= now:
+                    t = heapq.heappop(self._timers)
+                    if t[2] is not None:
+                        ready.append((t[2], t[3]))
+                if ready or self._ready:
+                    timeout = 0
+                elif self._timers:
+                    timeout = max(0, self._timers[0][0] - now)
+                else:
+                    timeout = None
+            for fn, args in ready:
+                _run_callback(lambda _: fn(*args), None)
+            for fd, readable, writable in self._wait(timeout):
+                handlers = self._handlers.get(fd)
+                if handlers is None: continue
+                reader, writer = handlers
+                if readable and reader:
+                    _run_callback(lambda _: reader(), None)
+                    handlers = self._handlers.get(fd, (None, None))
+                    writer = handlers[1]
+                if writable and writer:
+                    _run_callback(lambda _: writer(), None)
+
+class _ResponseParser(object):
+    """Incremental parser for an HTTP/1.1 response."""
+    def __init__(self, method):
+        self.method   = method
+        self.status   = None
+        self.reason   = None
+        self.headers  = {}
+        self.body     = []
+        self.complete = False
+        self.received = False
+        self._buf     = ''
+        self._state   = 'status'
+        self._left    = None
+
+    def will_close(self):
+        conn = self.headers.get('connection', '').lower()
+        return conn == 'close' or self._state == 'eof'
+
+    def feed(self, data):
+        """Consume ``data``; returns True once the response is complete."""
+        self.received = True
+        self._buf += data
+        while not self.complete:
+            if self._state in ('status', 'headers', 'size', 'trailer'):
+                i = self._buf.find('\r\n')
+                if i < 0: return False
+                line, self._buf = self._buf[:i], self._buf[i + 2:]
+                self._line(line)
+            elif self._state == 'body':
+                n = min(self._left, len(self._buf))
+                if n == 0: return False
+                self.body.append(self._buf[:n])
+                self._buf, self._left = self._buf[n:], self._left - n
+                if self._left == 0:
+                    self._state = 'crlf' if self._chunked else None
+                    if not self._chunked: self.complete = True
+            elif self._state == 'crlf':
+                if len(self._buf) < 2: return False
+                self._buf, self._state = self._buf[2:], 'size'
+            elif self._state == 'eof':
+                self.body.append(self._buf)
+                self._buf = ''
+                return False
+        return True
+
+    def eof(self):
+        """Handle the server closing the connection; returns True if complete."""
+        if self._state == 'eof':
+            self.complete = True
+        return self.complete
+
+    def _line(self, line):
+        if self._state == 'status':
+            parts = line.split(None, 2)
+            if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+                raise HTTPException("bad status line %r" % line)
+            self.status = int(parts[1])
+            self.reason = parts[2] if len(parts) > 2 else ''
+            self._state = 'headers'
+        elif self._state == 'headers':
+            if line:
+                k, _, v = line.partition(':')
+                self.headers[k.strip().lower()] = v.strip()
+                return
+            if 100 <= self.status < 200:
+                buf = self._buf
+                self.__init__(self.method)
+                self._buf, self.received = buf, True
+                return
+            self._chunked = self.headers.get('transfer-encoding', '').lower() == 'chunked'
+            if self.method == 'HEAD' or self.status in (204, 304):
+                self.complete = True
+            elif self._chunked:
+                self._state = 'size'
+            elif 'content-length' in self.headers:
+                self._left = int(self.headers['content-length'])
+                self._state = 'body'
+                if self._left == 0: self.complete = True
+            else:
+                self._state = 'eof'
+        elif self._state == 'size':
+            self._left = int(line.split(';')[0], 16)
+            self._state = 'body' if self._left else 'trailer'
+        elif self._state == 'trailer':
+            if not line: self.complete = True
+
+class _AsyncConnection(object):
+    """A non-blocking keep-alive connection running one request at a time."""
+    def __init__(self, pool, key):
+        self.pool   = pool
+        self.loop   = pool.loop
+        self.key    = key
+        self.sock   = None
+        self.req    = None
+        self.reused = False
+
+    def start(self, req):
+        self.req = req
+        self.parser = _ResponseParser(req.method)
+        self.out = req.head
+        self.offset = 0
+        self.body = req.blocks()
+        self.sent = 0
+        self.times = {}
+        if self.sock is None:
+            self._connect()
+        else:
+            self.reused = True
+            self.loop.watch(self.sock.fileno(), None, self._on_write)
+
+    def _connect(self):
+        host, port, https = self.key
+        family, socktype, proto, _, addr = self.pool.resolve(host, port)
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        err = self.sock.connect_ex(addr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, os.strerror(err))
+        self.loop.watch(self.sock.fileno(), None, self._on_connect)
+
+    def _on_connect(self):
+        self._guard(self._connected)
+
+    def _connected(self):
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, os.strerror(err))
+        host, port, https = self.key
+        if https:
+            self.sock = self.pool.ssl_context.wrap_socket(
+                self.sock, server_hostname=host, do_handshake_on_connect=False)
+            self._handshake()
+        else:
+            self.loop.watch(self.sock.fileno(), None, self._on_write)
+
+    def _handshake(self):
+        fd = self.sock.fileno()
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.loop.watch(fd, lambda: self._guard(self._handshake), None)
+            return
+        except ssl.SSLWantWriteError:
+            self.loop.watch(fd, None, lambda: self._guard(self._handshake))
+            return
+        self.loop.watch(fd, None, self._on_write)
+
+    def _on_write(self):
+        self._guard(self._write)
+
+    def _write(self):
+        fd = self.sock.fileno()
+        self.times.setdefault('send', time.time())
+        while True:
+            if self.offset >= len(self.out):
+                self.out, self.offset = next(self.body, None), 0
+                if self.out is None:
+                    self.times['sent'] = time.time()
+                    self.loop.watch(fd, self._on_read, None)
+                    return
+                continue
+            try:
+                n = self.sock.send(buffer(self.out, self.offset, CHUNK_SIZE))
+            except ssl.SSLWantReadError:
+                self.loop.watch(fd, self._on_write, None)
+                return
+            except (ssl.SSLWantWriteError, socket.error), e:
+                if isinstance(e, socket.error) and e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                self.loop.watch(fd, None, self._on_write)
+                return
+            self.offset += n
+            self.sent += n
+
+    def _on_read(self):
+        self._guard(self._read)
+
+    def _read(self):
+        while True:
+            try:
+                data = self.sock.recv(CHUNK_SIZE)
+            except ssl.SSLWantReadError:
+                return
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK): return
+                raise
+            self.times.setdefault('ttfb', time.time())
+            if not data:
+                if not self.parser.eof():
+                    raise HTTPException("connection closed by server")
+                self.close()
+                self._done(False)
+                return
+            if self.parser.feed(data):
+                self._done(not self.parser.will_close())
+                return
+
+    def _on_idle(self):
+        # an idle connection became readable: the server closed it
+        self.pool.discard(self)
+
+    def _guard(self, fn):
+        try:
+            fn()
+        except Exception, e:
+            self.close()
+            req, self.req = self.req, None
+            if req is None: return
+            # a request sent in full may have been processed: only resend it if that is safe
+            safe = 'sent' not in self.times or req.method in ('GET', 'DELETE')
+            self.pool.failed(self, req, e, sys.exc_info()[2],
+                             self.reused and not self.parser.received and safe)
+
+    def _done(self, keep):
+        req, self.req = self.req, None
+        p = self.parser
+        if req.sample is not None:
+            t, now = self.times, time.time()
+            req.sample['phases'].update(send=t['sent'] - t['send'], ttfb=t['ttfb'] - t['sent'],
+                                        read=now - t['ttfb'])
+            req.sample['bytes_sent'] = self.sent
+        self.pool.release(self, keep and self.sock is not None)
+        req.finish((p.status, p.reason, p.headers, ''.join(p.body)))
+
+    def close(self):
+        if self.sock is not None:
+            self.loop.unwatch(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+
+class _AsyncRequest(object):
+    def __init__(self, key, method, url, body, headers, future, timeout, sample=None):
+        host, port, https = key
+        length = _body_length(body)
+        if port == (443 if https else 80):
+            hostheader = host
+        else:
+            hostheader = "%s:%s" % (host, port)
+        lines = ["%s %s HTTP/1.1" % (method, url), "Host: %s" % hostheader]
+        if 'Accept-Encoding' not in headers:
+            lines.append("Accept-Encoding: identity")
+        for k, v in headers.iteritems():
+            lines.append("%s: %s" % (k, v))
+        if length is None:
+            lines.append("Transfer-Encoding: chunked")
+        else:
+            lines.append("Content-Length: %d" % length)
+        self.key     = key
+        self.method  = method
+        self.head    = "\r\n".join(lines) + "\r\n\r\n"
+        self.body    = body
+        self.length  = length
+        self.rewind  = _rewind(body)
+        self.future  = future
+        self.timeout = timeout
+        self.timer   = None
+        self.sample  = sample
+
+    def blocks(self):
+        """Yield the body, framed for chunked transfer encoding if needed."""
+        body = self.body
+        if isinstance(body, basestring):
+            if body: yield body
+        elif self.length is not None:
+            for chunk in _iter_chunks(body):
+                yield chunk
+        else:
+            for chunk in _iter_chunks(body):
+                yield "%x\r\n%s\r\n" % (len(chunk), chunk)
+            yield "0\r\n\r\n"
+
+    def finish(self, result):
+        if self.timer is not None:
+            self.timer[2] = None
+        self.future.set_result(result)
+
+    def fail(self, e, tb=None):
+        if self.timer is not None:
+            self.timer[2] = None
+        self.future.set_exception(e, tb)
+
+class _AsyncPool(object):
+    """
+Keep-alive connections of one AsyncPrecog client. Only used on the loop
+thread. At most ``max_connections`` are open per server; further requests wait
+for a connection to be released.
+    """
+    def __init__(self, loop, max_connections):
+        self.loop            = loop
+        self.max_connections = max_connections
+        self.ssl_context     = ssl.create_default_context()
+        self._addrs          = {}
+        self._idle           = {}
+        self._active         = {}
+        self._waiting        = {}
+
+    def resolve(self, host, port):
+        # name lookups block, so each server is only resolved once
+        key = (host, port)
+        if key not in self._addrs:
+            self._addrs[key] = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        return self._addrs[key]
+
+    def submit(self, req):
+        if req.future.done():
+            return
+        if req.timeout is not None and req.timer is None:
+            req.timer = self.loop.call_later(req.timeout, self._timeout, req)
+        key = req.key
+        idle = self._idle.get(key)
+        if idle:
+            conn = idle.pop()
+            self._active[key] = self._active.get(key, 0) + 1
+            self._start(conn, req)
+        elif self._active.get(key, 0) < self.max_connections:
+            self._active[key] = self._active.get(key, 0) + 1
+            self._start(_AsyncConnection(self, key), req)
+        else:
+            self._waiting.setdefault(key, collections.deque()).append(req)
+
+    def _start(self, conn, req):
+        req.conn = conn
+        conn._guard(lambda: conn.start(req))
+
+    def _timeout(self, req):
+        conn = getattr(req, 'conn', None)
+        if conn is not None and conn.req is req:
+            conn.req = None
+            conn.close()
+            self.release(conn, False)
+        req.fail(socket.timeout("timed out"))
+
+    def release(self, conn, keep):
+        key = conn.key
+        self._active[key] -= 1
+        if keep:
+            conn.reused = False
+            self._idle.setdefault(key, []).append(conn)
+            self.loop.watch(conn.sock.fileno(), conn._on_idle, None)
+        else:
+            conn.close()
+        waiting = self._waiting.get(key)
+        while waiting:
+            req = waiting.popleft()
+            if not req.future.done():
+                self.submit(req)
+                break
+
+    def discard(self, conn):
+        conn.close()
+        idle = self._idle.get(conn.key, [])
+        if conn in idle: idle.remove(conn)
+
+    def failed(self, conn, req, e, tb, retry):
+        self.release(conn, False)
+        if retry and req.rewind is not None:
+            req.rewind()
+            self._active[req.key] = self._active.get(req.key, 0) + 1
+            self._start(_AsyncConnection(self, req.key), req)
+        else:
+            req.fail(e, tb)
+
+class AsyncPrecog(Precog):
+    """
+Non-blocking client for the Precog API.
+
+AsyncPrecog has the same methods as ``Precog``, but each one returns a
+``Future`` immediately instead of waiting for the server. The requests of all
+AsyncPrecog clients sharing an ``EventLoop`` are driven by that loop's single
+thread over non-blocking keep-alive connections, so thousands of appends and
+queries may be in flight at once::
+
+    futures = [client.query(q) for q in queries]
+    results = [f.result() for f in futures]
+
+Arguments and keyword arguments are the same as for ``Precog``, plus:
+
+Keyword Arguments:
+ * loop (EventLoop): Loop to run requests on (defaults to
+   ``EventLoop.default()``).
+ * max_connections (int): Maximum number of open connections to the server.
+ * timeout (float): Seconds before a request fails with ``socket.timeout``.
+    """
+    def __init__(self, apikey, accountid, basepath=None, host='beta.precog.com', port=443, https=True,
+                 loop=None, max_connections=64, timeout=None, **kw):
+        if kw.get('limiter') is not None:
+            # waiting for a slot would block the caller (or the event loop itself)
+            raise PrecogClientError("AsyncPrecog does not support a limiter; use max_connections")
+        Precog.__init__(self, apikey, accountid, basepath, host, port, https, **kw)
+        self.loop    = EventLoop.default() if loop is None else loop
+        self.timeout = timeout
+        self._apool  = _AsyncPool(self.loop, max_connections)
+
+    def _doit(self, name, path, body, params, headers, void=False):
+        url = self._url(path, params)
+        future = Future()
+        if self.hosts is None:
+            key = (self.host, self.port, self.https)
+        else:
+            key = self.hosts.acquire()
+            t0 = time.time()
+            def release(f):
+                ok = f.exception() is None and f.result()[0] < 500
+                self.hosts.release(key, time.time() - t0, ok)
+            future.add_done_callback(release)
+        ebody, eheaders = self._encode(body, headers)
+        sample = None if self.metrics is None else self.metrics.sample(name, path)
+        req = _AsyncRequest(key, name, url, ebody, eheaders, future, self.timeout, sample)
+        t0 = time.time()
+        self.loop.call_soon(self._apool.submit, req)
+        def response((status, reason, hdrs, data)):
+            if sample is not None: sample['bytes_received'] = len(data)
+            data = _decompress(data, hdrs.get('content-encoding'))
+            return self._response(url, body, params, headers, status, reason, data, void, sample)
+        result = future.then(response)
+        if sample is not None:
+            result.add_done_callback(lambda f: self._record(sample, t0, f.exception()))
+        return result
+
+    def query(self, query, path="", detailed=False):
+        """Like ``Precog.query``, but returns a ``Future``."""
+        return self._query(query, path, detailed, self._query_args)
+
+    def _query(self, query, path, detailed, args):
+        key = (self.host, self.basepath, path, query, detailed)
+        if self.cache is not None:
+            found, result = self.cache.get(key)
+            if found:
+                future = Future()
+                future.set_result(result)
+                return future
+        fullpath, params = args(query, path)
+        future = self._get(fullpath, params=params).then(lambda d: _query_result(d, detailed))
+        if self.cache is not None:
+            querypath = ujoins(self.basepath, path)
+            future.add_done_callback(lambda f: f.exception() or self.cache.put(key, f.result(), querypath))
+        return future
+
+    def async_query(self, query, path="", detailed=False):
+        """Not needed by AsyncPrecog: ``query`` already returns a ``Future``."""
+        raise PrecogClientError("query jobs are only supported by Precog")
+
+    def query_many(self, queries, concurrency=8, detailed=False):
+        """Not needed by AsyncPrecog: call ``query`` for each query and wait on the futures."""
+        raise PrecogClientError("query_many is only supported by Precog")
+
+    def query_many_iter(self, queries, concurrency=8, detailed=False):
+        """Not needed by AsyncPrecog: call ``query`` for each query and wait on the futures."""
+        raise PrecogClientError("query_many_iter is only supported by Precog")
+
+    def _ingest(self, path, format, bytes, mode, receipt):
+        future = Precog._ingest(self, path, format, bytes, mode, receipt)
+        future.add_done_callback(lambda _: self._invalidate(path))
+        return future
+
+    def append_stream(self, dest, objs, buffered=0):
+        """
+Like ``Precog.append_stream``, but returns a ``Future``. By default the
+objects are serialized on the event loop thread as the body is sent.
+        """
+        return Precog.append_stream(self, dest, objs, buffered)
+
+    def append_routed(self, objs, key_fn, concurrency=8, max_bytes=1024 * 1024,
+                      max_buffered_bytes=16 * 1024 * 1024):
+        """Not supported by AsyncPrecog: use ``append_stream`` for each path."""
+        raise PrecogClientError("AsyncPrecog does not support append_routed")
+
+    def wait_until_visible(self, dest, expected_count, timeout=30.0, at_least=False):
+        """Like ``Precog.wait_until_visible``, but returns a ``Future``."""
+        return _visibility.add(self, ujoin('/', dest), expected_count, timeout, at_least)
+
+    def delete(self, path):
+        """Like ``Precog.delete``, but returns a ``Future``."""
+        future = Precog.delete(self, path)
+        future.add_done_callback(lambda _: self._invalidate(path))
+        return future
+
+    def upload_file(self, dest, format, src, parallel=1, chunk_size=None):
+        """Like ``Precog.upload_file``, but returns a ``Future``."""
+        return self.delete(dest).then(
+            lambda _: self._ingest_file(dest, format, src, parallel, chunk_size))
+
+    def upload_string(self, dest, format, src):
+        """Like ``Precog.upload_string``, but returns a ``Future``."""
+        return self.delete(dest).then(
+            lambda _: self._ingest(dest, format, src, mode='batch', receipt='true'))
+
+    def append_all(self, dest, objs, processes=1, shard_size=10000, pool=None):
+        """Like ``Precog.append_all``, but returns a ``Future``."""
+        if processes > 1:
+            # the shards would be waited for on the event loop thread
+            raise PrecogClientError("AsyncPrecog does not support serializing on processes")
+        return Precog.append_all(self, dest, objs)
+
+    def _ingest_file(self, dest, format, src, parallel=1, chunk_size=None):
+        if parallel > 1:
+            raise PrecogClientError("AsyncPrecog does not support parallel file ingest")
+        if type(src) == str or type(src) == unicode:
+            f = open(src, 'rb')
+            future = self._ingest(dest, format, f, mode='batch', receipt='true')
+            future.add_done_callback(lambda _: f.close())
+            return future
+        return self._ingest(dest, format, src, mode='batch', receipt='true')
 
 #def to_token(user, pwd, host, accountid, apikey, root_path):
 #    s = "%s:%s:%s:%s:%s:%s" % (user, pwd, host, accountid, apikey, root_path)
@@ -0,0 +1,383 @@
+# This file is subject to the terms and conditions defined in LICENSE.
+# (c) 2011-2013, ReportGrid Inc. All rights reserved.
+
+"""
+A local stand-in for the Precog API, for tests and benchmarks that should not
+depend on a live server.
+
+FakePrecog implements enough of the ingest (``/ingest/v1/fs``), analytics
+(``/analytics/v1/fs`` and ``/analytics/v1/queries``) and accounts
+(``/accounts/v1``) services for the client to run against it. Data is kept in
+memory. Only a tiny subset of Quirrel is understood: ``//path``,
+``load("/path")``, ``count(...)`` of either, and array literals of those
+(e.g. ``[count(//a), count(//b)]``).
+
+Artificial latency (seconds added before each response) and bandwidth (bytes
+per second, applied to request and response bodies) can be configured to
+model a remote server::
+
+    server = FakePrecog(latency=0.02, bandwidth=10 * 1024 * 1024).start()
+    client = Precog(server.apikey, server.accountid, host='127.0.0.1',
+                    port=server.port, https=False)
+"""
+
+import BaseHTTPServer
+import SocketServer
+import base64
+import csv
+import json
+import re
+import threading
+import time
+import urlparse
+import zlib
+from StringIO import StringIO
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+    request_queue_size  = 256
+
+    def handle_error(self, request, client_address):
+        # clients hanging up mid-request (e.g. aborted hedges) are expected
+        pass
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize         = -1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self): self._dispatch('GET')
+    def do_POST(self): self._dispatch('POST')
+    def do_DELETE(self): self._dispatch('DELETE')
+
+    def _dispatch(self, method):
+        fake = self.server.fake
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        body = self._read_body()
+        with fake._lock:
+            fake.requests += 1
+            n = fake.requests
+            fake.in_flight += 1
+            overloaded = fake.max_concurrent is not None and fake.in_flight > fake.max_concurrent
+            if overloaded: fake.rejected += 1
+        try:
+            if fake.latency:
+                time.sleep(fake.latency)
+            if fake.slow and n % fake.slow[0] == 0:
+                time.sleep(fake.slow[1])
+            if overloaded:
+                status, result = 503, {'errors': ['overloaded']}
+            else:
+                status, result = fake.handle(method, urlparse.unquote(url.path), params, body,
+                                             self.headers)
+        except Exception, e:
+            status, result = 500, {'error': str(e)}
+        finally:
+            with fake._lock:
+                fake.in_flight -= 1
+                drop = fake.drop > 0
+                if drop: fake.drop -= 1
+        if drop:
+            self.close_connection = 1
+            return
+        self._reply(status, result)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            parts = []
+            while True:
+                n = int(self.rfile.readline().split(';')[0], 16)
+                if n == 0:
+                    while self.rfile.readline().strip(): pass
+                    break
+                parts.append(self.rfile.read(n))
+                self.rfile.readline()
+            body = ''.join(parts)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.fake.throttle(len(body))
+        encoding = self.headers.get('Content-Encoding')
+        if encoding == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+        return body
+
+    def _reply(self, status, result):
+        data = '' if result is None else json.dumps(result)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if data and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = z.compress(data) + z.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.server.fake.throttle(len(data))
+        self.wfile.write(data)
+
+class FakePrecog(object):
+    """
+An in-memory Precog server listening on a local port.
+
+Keyword Arguments:
+ * host (str): Interface to listen on.
+ * port (int): Port to listen on (0 picks a free port).
+ * latency (float): Seconds added before every response.
+ * bandwidth (int): Bytes per second for request and response bodies, or None
+   for no limit.
+ * job_delay (float): Seconds before a query job's results are ready.
+ * max_concurrent (int): Requests handled at once before the server answers
+   503 (overloaded), or None for no limit.
+ * visibility_delay (float): Seconds before ingested events show up in queries.
+
+Setting the ``drop`` attribute to N makes the server handle the next N requests
+but close the connection instead of answering them. Ingests to the paths in the
+``reject`` set are answered with a 400. Setting ``slow`` to ``(n, seconds)``
+delays every n-th request by that many more seconds.
+    """
+    apikey    = 'FAKE-API-KEY'
+    accountid = '0000000001'
+    email     = 'test@precog.com'
+    password  = 'password'
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, bandwidth=None, job_delay=0.0,
+                 max_concurrent=None, visibility_delay=0.0):
+        self.latency   = latency
+        self.visibility_delay = visibility_delay
+        self.drop      = 0
+        self.reject    = set()
+        self.slow      = None
+        self.queries   = 0
+        self._pending  = []
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self.rejected  = 0
+        self.bandwidth = bandwidth
+        self.job_delay = job_delay
+        self.requests  = 0
+        self.data      = {}
+        self.jobs      = {}
+        self.accounts  = {self.email: {'accountId': self.accountid, 'email': self.email,
+                                       'password': self.password, 'apiKey': self.apikey}}
+        self._lock     = threading.Lock()
+        self._server   = _Server((host, port), _Handler)
+        self._server.fake = self
+        self.host, self.port = self._server.server_address[:2]
+        self._thread   = None
+
+    def start(self):
+        """Serve requests from a background thread; returns self."""
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-precog')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def throttle(self, nbytes):
+        if self.bandwidth:
+            time.sleep(float(nbytes) / self.bandwidth)
+
+    def events(self, path):
+        """Return the events stored at ``path`` and below it."""
+        path = _norm(path)
+        with self._lock:
+            now = time.time()
+            while self._pending and self._pending[0][0] <= now:
+                t, p, evs = self._pending.pop(0)
+                self.data.setdefault(p, []).extend(evs)
+            out = []
+            for p, evs in self.data.iteritems():
+                if p == path or p.startswith(path + '/') or path == '/':
+                    out.extend(evs)
+            return out
+
+    def handle(self, method, path, params, body, headers):
+        """Return ``(status, result)`` for a request."""
+        for prefix, handler in (('/ingest/v1/fs', self._ingest),
+                                ('/analytics/v1/fs', self._query),
+                                ('/analytics/v1/queries', self._job),
+                                ('/accounts/v1/accounts', self._accounts)):
+            if path.startswith(prefix):
+                if prefix != '/accounts/v1/accounts' and params.get('apiKey') != self.apikey:
+                    return 403, {'errors': ['invalid api key']}
+                return handler(method, path[len(prefix):], params, body, headers)
+        return 404, {'errors': ['not found: %s' % path]}
+
+    def _ingest(self, method, path, params, body, headers):
+        path = _norm(path)
+        if method == 'DELETE':
+            with self._lock:
+                for p in self.data.keys():
+                    if p == path or p.startswith(path + '/'):
+                        del self.data[p]
+                self._pending = [e for e in self._pending
+                                 if not (e[1] == path or e[1].startswith(path + '/'))]
+            return 200, None
+        if method != 'POST':
+            return 405, {'errors': ['method not allowed']}
+        if path in self.reject:
+            return 400, {'errors': ['rejected: %s' % path]}
+        try:
+            events = _parse(headers.get('Content-Type', ''), params, body)
+        except ValueError, e:
+            return 400, {'errors': [str(e)]}
+        with self._lock:
+            if self.visibility_delay:
+                self._pending.append((time.time() + self.visibility_delay, path, events))
+            else:
+                self.data.setdefault(path, []).extend(events)
+        n = len(events)
+        if params.get('receipt') == 'false':
+            return 202, None
+        return 200, {'total': n, 'ingested': n, 'failed': 0, 'skipped': 0, 'errors': []}
+
+    def _run(self, basepath, q):
+        try:
+            return {'serverErrors': [], 'serverWarnings': [], 'errors': [], 'warnings': [],
+                    'data': _Quirrel(self, basepath, q).evaluate()}
+        except ValueError, e:
+            return {'serverErrors': [], 'serverWarnings': [], 'errors': [str(e)], 'warnings': [],
+                    'data': []}
+
+    def _query(self, method, path, params, body, headers):
+        if method != 'GET':
+            return 405, {'errors': ['method not allowed']}
+        with self._lock:
+            self.queries += 1
+        return 200, self._run(path, params.get('q', ''))
+
+    def _job(self, method, path, params, body, headers):
+        if method == 'POST' and path.strip('/') == '':
+            with self._lock:
+                jobid = 'job%d' % (len(self.jobs) + 1)
+                self.jobs[jobid] = (time.time() + self.job_delay, params.get('basePath', ''), params.get('q', ''))
+            return 202, {'jobId': jobid}
+        parts = path.strip('/').split('/')
+        job = self.jobs.get(parts[0])
+        if method != 'GET' or job is None:
+            return 404, {'errors': ['no such job']}
+        ready = time.time() >= job[0]
+        if parts[1:] == ['status']:
+            return 200, {'jobId': parts[0], 'state': 'complete' if ready else 'running'}
+        if not ready:
+            return 202, None
+        return 200, self._run(job[1], job[2])
+
+    def _accounts(self, method, path, params, body, headers):
+        path = path.strip('/')
+        if method == 'POST' and not path:
+            d = json.loads(body)
+            with self._lock:
+                if d['email'] not in self.accounts:
+                    accountid = '%010d' % (len(self.accounts) + 1)
+                    self.accounts[d['email']] = {'accountId': accountid, 'email': d['email'],
+                                                 'password': d['password'], 'apiKey': self.apikey}
+            return 200, {'accountId': self.accounts[d['email']]['accountId']}
+        if method == 'GET' and path == 'search':
+            a = self.accounts.get(params.get('email'))
+            return 200, [{'accountId': a['accountId']}] if a else []
+        if method == 'GET' and path:
+            auth = headers.get('Authorization', '')
+            for a in self.accounts.values():
+                if a['accountId'] == path:
+                    expected = 'Basic ' + base64.standard_b64encode('%s:%s' % (a['email'], a['password']))
+                    if auth != expected:
+                        return 401, {'errors': ['unauthorized']}
+                    return 200, dict((k, v) for k, v in a.iteritems() if k != 'password')
+        return 404, {'errors': ['no such account']}
+
+def _norm(path):
+    return '/' + '/'.join(p for p in path.split('/') if p)
+
+_decoder = json.JSONDecoder()
+_ws = re.compile(r'\s*')
+
+def _parse(mime, params, body):
+    """Decode an ingest body into a list of events."""
+    mime = mime.split(';')[0].strip()
+    if mime == 'application/json':
+        v = json.loads(body)
+        return v if isinstance(v, list) else [v]
+    if mime == 'application/x-json-stream':
+        out, i = [], _ws.match(body, 0).end()
+        while i < len(body):
+            v, i = _decoder.raw_decode(body, i)
+            out.append(v)
+            i = _ws.match(body, i).end()
+        return out
+    if mime == 'text/csv':
+        quote = params.get('quote', '"')
+        escape = params.get('escape', '"')
+        kw = {'delimiter': params.get('delim', ','), 'quotechar': quote}
+        if escape != quote:
+            kw.update(escapechar=escape, doublequote=False)
+        rows = list(csv.reader(StringIO(body), **kw))
+        if not rows: return []
+        header = rows[0]
+        return [dict(zip(header, [_scalar(v) for v in row])) for row in rows[1:] if row]
+    raise ValueError("unsupported content type %r" % mime)
+
+def _scalar(s):
+    for t in (int, float):
+        try:
+            return t(s)
+        except ValueError:
+            pass
+    return s
+
+class _Quirrel(object):
+    """Evaluates the handful of Quirrel expressions FakePrecog understands."""
+    token = re.compile(r'\s*(//[^\s,\)\]]*|load\s*\(\s*"[^"]*"\s*\)|count\s*\(|[\[\],\)])')
+
+    def __init__(self, fake, basepath, q):
+        self.fake = fake
+        self.basepath = basepath
+        self.tokens = []
+        i, q = 0, q.strip()
+        while i < len(q):
+            m = self.token.match(q, i)
+            if m is None:
+                raise ValueError("unsupported query: %r" % q)
+            self.tokens.append(m.group(1))
+            i = m.end()
+            while i < len(q) and q[i].isspace(): i += 1
+
+    def evaluate(self):
+        v = self._expr()
+        if self.tokens:
+            raise ValueError("unexpected %r" % self.tokens[0])
+        return v
+
+    def _next(self):
+        if not self.tokens:
+            raise ValueError("unexpected end of query")
+        return self.tokens.pop(0)
+
+    def _expr(self):
+        t = self._next()
+        if t == '[':
+            items = [self._expr()]
+            while self.tokens and self.tokens[0] == ',':
+                self._next()
+                items.append(self._expr())
+            if self._next() != ']':
+                raise ValueError("expected ]")
+            return [[v[0] if v else None for v in items]]
+        if t.startswith('count'):
+            v = self._expr()
+            if self._next() != ')':
+                raise ValueError("expected )")
+            return [len(v)]
+        if t.startswith('//'):
+            return self.fake.events(self.basepath + '/' + t[2:])
+        if t.startswith('load'):
+            return self.fake.events(self.basepath + '/' + t.split('"')[1])
+        raise ValueError("unexpected %r" % t)
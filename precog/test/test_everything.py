@@ -25,17 +25,6 @@ def teardown_module(m):
     pass
 
 class TestEverything:
-    def queryUntil(self, bp, q, expected, timeout=30):
-        t0 = time.time()
-        res = None
-        while time.time() - t0 < timeout:
-            print "  trying..."
-            res = self.api.query(q, bp)
-            if res == expected:
-                return
-            time.sleep(0.5)
-        assert res == expected, res
-
     def test_csv(self):
         # csv
         csvdata = "foo,bar,qux\n1,2,3\n4,5,6\n"
@@ -71,7 +60,7 @@ class TestEverything:
 
     def test_populate1(self):
         self.api.delete("qux/test")
-        self.queryUntil("qux", "count(//test)", [0])
+        assert self.api.wait_until_visible("qux/test", 0)
         print "delete qux/test: ok"
 
         objs = []
@@ -80,7 +69,7 @@ class TestEverything:
         assert response['ingested'] == 100, response
         print "populate qux/test: ok"
 
-        self.queryUntil("qux", "count(//test)", [100])
+        assert self.api.wait_until_visible("qux/test", 100)
         print "count qux/test: ok"
 
     def test_upload(self):
@@ -92,6 +81,6 @@ class TestEverything:
         assert response['ingested'] == 60, response
         print "upload new qux/test: ok"
 
-        self.queryUntil("qux", "count(//test)", [60])
+        assert self.api.wait_until_visible("qux/test", 60)
         print "count qux/test again: ok"
 
@@ -0,0 +1,619 @@
+# This file is subject to the terms and conditions defined in LICENSE.
+# (c) 2011-2013, ReportGrid Inc. All rights reserved.
+
+# These tests run against the local FakePrecog server, so they do not need a
+# live Precog account.
+
+from precog import *
+from precog.test.fakeserver import FakePrecog
+from StringIO import StringIO
+from httplib import HTTPException
+from multiprocessing.pool import ThreadPool
+import gc
+import json
+import multiprocessing
+import os
+import precog
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import weakref
+
+def setup_module(m):
+    server = FakePrecog().start()
+    m.TestLocal.server = server
+    m.TestLocal.pool = ConnectionPool()
+    m.TestLocal.api = Precog(server.apikey, server.accountid, host=server.host,
+                             port=server.port, https=False, pool=m.TestLocal.pool)
+
+def teardown_module(m):
+    m.TestLocal.server.stop()
+
+class TestLocal:
+    def client(self, **kw):
+        s = self.server
+        return Precog(s.apikey, s.accountid, host=s.host, port=s.port, https=False, **kw)
+
+    def test_accounts(self):
+        accountid = self.api.search_account(self.server.email)[0]['accountId']
+        assert accountid == self.server.accountid
+        d = self.api.account_details(self.server.email, self.server.password, accountid)
+        assert d['apiKey'] == self.server.apikey, d
+
+    def test_append_and_query(self):
+        self.api.delete("local/append")
+        response = self.api.append("local/append", [1, 2, 3])
+        assert response['ingested'] == 1, response
+        response = self.api.append_all("local/append", [{"a": 1}, {"a": 2}])
+        assert response['ingested'] == 2, response
+        assert self.api.query("count(//local/append)") == [3]
+
+    def test_append_stream(self):
+        self.api.delete("local/stream")
+        response = self.api.append_all("local/stream", ({"i": i} for i in xrange(50000)))
+        assert response['ingested'] == 50000, response
+        assert self.api.query("count(//local/stream)") == [50000]
+
+    def test_append_all_processes(self):
+        objs = [{"i": i, "s": u"caf\xe9", "l": [i, None, True]} for i in range(1000)]
+        self.api.delete("local/sharded")
+        response = self.api.append_all("local/sharded", objs, processes=2, shard_size=64)
+        assert response['ingested'] == 1000, response
+        assert self.server.events("/%s/local/sharded" % self.server.accountid) == objs
+        pool = multiprocessing.Pool(2)
+        try:
+            self.api.delete("local/sharded")
+            response = self.api.append_all("local/sharded", objs, processes=2, shard_size=64,
+                                           pool=pool)
+            assert response['ingested'] == 1000, response
+            assert self.server.events("/%s/local/sharded" % self.server.accountid) == objs
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def test_append_routed(self):
+        for t in range(5):
+            self.api.delete("local/routed/t%d" % t)
+        events = ({"tenant": i % 5, "i": i} for i in xrange(5000))
+        receipts = self.api.append_routed(events, lambda e: "local/routed/t%d" % e["tenant"],
+                                          concurrency=4, max_bytes=4096, max_buffered_bytes=8192)
+        assert sorted(receipts) == ["local/routed/t%d" % t for t in range(5)]
+        assert all(r['ingested'] == 1000 for r in receipts.values()), receipts
+        assert self.api.query("count(//local/routed/t3)") == [1000]
+
+    def test_append_routed_error(self):
+        bad = "/%s/local/routed/bad" % self.server.accountid
+        self.server.reject.add(bad)
+        read = [0]
+        def events():
+            for i in xrange(100000):
+                read[0] += 1
+                yield {"tenant": "bad" if i % 2 else "ok", "i": i}
+        try:
+            self.api.append_routed(events(), lambda e: "local/routed/" + e["tenant"],
+                                   concurrency=1, max_bytes=1024)
+            assert False, "expected the rejected group to raise"
+        except PrecogServiceError, e:
+            assert e.status == 400
+            assert [dest for dest, _ in e.errors] == ["local/routed/bad"]
+            assert e.receipts.keys() in ([], ["local/routed/ok"]), e.receipts
+        finally:
+            self.server.reject.discard(bad)
+        assert read[0] < 100000
+
+    def test_nothing_to_ingest(self):
+        api = self.client(pool=ConnectionPool())
+        for args in (("local/empty", Format.json, None), ("local/empty", Format.json, "")):
+            try:
+                api.append_all_from_string(*args)
+                assert False, "expected %r to be rejected" % (args,)
+            except PrecogClientError:
+                pass
+        try:
+            api.append_all("local/empty", (x for x in []))
+            assert False, "expected an empty generator to be rejected"
+        except PrecogClientError:
+            pass
+        assert api.pool.stats()['misses'] == 0
+
+    def test_append_stream_error(self):
+        def events():
+            for i in xrange(20000):
+                yield {"i": i}
+            raise ValueError("broken producer")
+        try:
+            self.api.append_stream("local/stream_error", events(), buffered=1)
+            assert False, "expected ValueError"
+        except ValueError:
+            pass
+        assert self.api.query("count(//nonexistent)") == [0]
+
+    def test_codec(self):
+        api = self.client(codec='json')
+        assert api.codec.dumps is json.dumps
+        api.delete("local/codec")
+        assert api.append("local/codec", [1, 2, 3])['ingested'] == 1
+        assert api.query("//local/codec") == [[1, 2, 3]]
+        try:
+            self.client(codec='nosuchlib')
+            assert False, "expected PrecogClientError"
+        except PrecogClientError:
+            pass
+
+    def test_connections_are_reused(self):
+        before = self.pool.stats()
+        for i in range(5):
+            self.api.query("count(//nonexistent)")
+        after = self.pool.stats()
+        assert after['misses'] - before['misses'] <= 1, (before, after)
+        assert after['hits'] - before['hits'] >= 4, (before, after)
+
+    def test_lost_response_is_not_resent(self):
+        api = self.client(pool=ConnectionPool())
+        api.delete("local/lost")
+        api.append("local/lost", {"i": 1})
+        # the server ingests the next POST but hangs up instead of answering
+        self.server.drop = 1
+        try:
+            api.append("local/lost", {"i": 2})
+            assert False, "expected the lost response to raise"
+        except (socket.error, HTTPException):
+            pass
+        assert self.server.events("/%s/local/lost" % self.server.accountid) == [{"i": 1}, {"i": 2}]
+        # a GET is safe to send again on a fresh connection
+        api.query("count(//nonexistent)")
+        self.server.drop = 1
+        assert api.query("count(//nonexistent)") == [0]
+
+    def test_file_ingest(self):
+        fd, name = tempfile.mkstemp()
+        try:
+            os.write(fd, "".join('{"i": %d}\n' % i for i in range(1000)))
+            os.close(fd)
+            response = self.api.upload_file("local/file", Format.jsonstream, name)
+            assert response['ingested'] == 1000, response
+            response = self.api.append_all_from_file("local/file", Format.jsonstream, StringIO('1\n2\n'))
+            assert response['ingested'] == 2, response
+        finally:
+            os.remove(name)
+
+    def test_parallel_csv(self):
+        csvdata = 'a,b\n' + ''.join('%d,"x\ny"\n' % i for i in range(20000))
+        self.api.delete("local/csv")
+        response = self.api.append_all_from_file("local/csv", Format.csv, StringIO(csvdata),
+                                                 parallel=4, chunk_size=64 * 1024)
+        assert response['ingested'] == 20000, response
+        assert response['errors'] == [], response
+        rows = self.server.events("/%s/local/csv" % self.server.accountid)
+        assert sorted(r['a'] for r in rows) == range(20000)
+        assert all(r['b'] == 'x\ny' for r in rows)
+
+    def test_compression(self):
+        api = self.client(compress='gzip', compress_min_size=10)
+        api.delete("local/gzip")
+        response = api.append_all("local/gzip", [{"i": i} for i in range(100)])
+        assert response['ingested'] == 100, response
+        assert api.query("count(//local/gzip)") == [100]
+
+    def test_query_iter(self):
+        self.api.delete("local/iter")
+        self.api.append_all("local/iter", [{"i": i} for i in range(500)])
+        results = self.api.query_iter("//local/iter")
+        assert [r['i'] for r in results] == range(500)
+        assert results.errors == []
+
+    def test_query_iter_large_value(self):
+        row = {"s": "x" * (4 * 1024 * 1024)}
+        data = StringIO(json.dumps([row, 1]))
+        reads = []
+        def read(n):
+            reads.append(n)
+            return data.read(n)
+        reader = precog._JsonReader(read)
+        reader.expect('[')
+        assert reader.value() == row
+        reader.expect(',')
+        assert reader.value() == 1
+        # a large value is read in growing blocks rather than re-decoded per block
+        assert len(reads) < 15, reads
+
+    def test_query_iter_split_numbers(self):
+        doc = '{"data": [12.5, -3.25e+10, 7, 1E-3, {"x": 0.125}], "errors": []}'
+        class Stream(object):
+            def __init__(self, parts): self.parts = parts
+            def read(self, n=None): return self.parts.pop(0) if self.parts else ''
+            def close(self): pass
+        for i in range(1, len(doc)):
+            rows = list(QueryResults(Stream([doc[:i], doc[i:]])))
+            assert rows == [12.5, -3.25e+10, 7, 1e-3, {"x": 0.125}], (i, rows)
+
+    def test_query_to_file(self):
+        self.api.delete("local/export")
+        self.api.append_all("local/export", [{"i": i, "s": u"caf\xe9, \"x\"", "n": None, "l": [i]}
+                                             for i in range(3)])
+        out = StringIO()
+        d = self.api.query_to_file("//local/export", out)
+        assert d['rows'] == 3 and d['bytes'] == len(out.getvalue()), d
+        assert [json.loads(line)['i'] for line in out.getvalue().splitlines()] == [0, 1, 2]
+        out = StringIO()
+        self.api.query_to_file("//local/export", out, format=Format.json)
+        assert json.loads(out.getvalue()) == self.api.query("//local/export")
+        fd, name = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            d = self.api.query_to_file("//local/export", name, format=Format.csv)
+            lines = open(name).read().splitlines()
+            assert lines[0] == 'i,l,n,s', lines
+            assert lines[1] == '0,[0],,"caf\xc3\xa9, ""x"""', lines
+            assert d['rows'] == 3 and len(lines) == 4
+        finally:
+            os.remove(name)
+
+    def test_query_cache(self):
+        cache = QueryCache()
+        api = self.client(cache=cache)
+        api.delete("local/cache")
+        assert api.query("count(//local/cache)") == [0]
+        assert api.query("count(//local/cache)") == [0]
+        assert cache.stats()['hits'] == 1
+        api.append("local/cache", 1)
+        assert api.query("count(//local/cache)") == [1]
+
+    def test_prepared_query(self):
+        cache = QueryCache()
+        api = self.client(cache=cache)
+        api.delete("local/prepared")
+        api.append_all("local/prepared", [{"i": i} for i in range(3)])
+        q = api.prepare('count(load($path))')
+        path = "/local/prepared"
+        assert q.render({"path": path}) == 'count(load("/local/prepared"))'
+        assert q.query({"path": path}) == [3]
+        assert api.query('count(load("/local/prepared"))') == [3]
+        assert cache.stats()['hits'] == 1
+        assert list(q.query_iter({"path": path})) == [3]
+        outcomes = api.query_many([(q, {"path": path}), (q, {})])
+        assert outcomes[0].result == [3]
+        assert isinstance(outcomes[1].error, PrecogClientError)
+        assert api.prepare('[$a, $b, $$]').render({"a": 'x"y', "b": [-1, True, None]}) == \
+            '["x\\"y", [(-1), true, null], $]'
+
+    def test_disk_query_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "cache.db")
+            self.api.delete("local/diskcache")
+            self.api.append_all("local/diskcache", [{"i": i} for i in range(5)])
+            # another process fills the cache...
+            def worker():
+                self.client(cache=DiskQueryCache(filename)).query("//local/diskcache")
+            p = multiprocessing.Process(target=worker)
+            p.start()
+            p.join()
+            assert p.exitcode == 0
+            # ...and this one reads it without asking the server
+            cache = DiskQueryCache(filename)
+            api = self.client(cache=cache)
+            queries = self.server.queries
+            assert [r['i'] for r in api.query("//local/diskcache")] == range(5)
+            assert self.server.queries == queries and cache.stats()['hits'] == 1
+            api.append("local/diskcache", {"i": 5})
+            assert len(api.query("//local/diskcache")) == 6
+            assert cache.invalidations == 1
+            small = DiskQueryCache(filename, max_bytes=1)
+            small.put(("x",), range(1000), "/x")
+            assert small.stats()['entries'] <= 1 and small.evictions > 0
+        finally:
+            shutil.rmtree(directory)
+
+    def test_query_many(self):
+        outcomes = self.api.query_many(["count(//a)", ("count(//b)", "x"), "bogus"], concurrency=2)
+        assert [o.index for o in outcomes] == [0, 1, 2]
+        assert outcomes[0].result == [0] and outcomes[1].result == [0]
+        assert isinstance(outcomes[2].error, PrecogClientError)
+
+    def test_query_job(self):
+        job = self.api.async_query("count(//nonexistent)")
+        assert job.result(timeout=10) == [0]
+        assert job.done()
+
+    def test_query_jobs_share_a_thread(self):
+        refs = []
+        for i in range(5):
+            api = self.client()
+            assert api.async_query("count(//nonexistent)").result(timeout=10) == [0]
+            refs.append(weakref.ref(api))
+        del api
+        gc.collect()
+        assert [r() for r in refs] == [None] * 5
+        # the poller's thread stops once no job is outstanding
+        for i in range(100):
+            if 'precog-jobs' not in [t.name for t in threading.enumerate()]: break
+            time.sleep(0.01)
+        else:
+            assert False, "the job poller is still running"
+
+    def test_async_client(self):
+        s = self.server
+        api = AsyncPrecog(s.apikey, s.accountid, host=s.host, port=s.port, https=False)
+        futures = [api.query("count(//nonexistent)") for i in range(20)]
+        assert [f.result(10) for f in futures] == [[0]] * 20
+        assert api.append("local/async", {"a": 1}).result(10)['ingested'] == 1
+        for method, args, kw in ((api.append_routed, ([{"a": 1}], lambda e: "local/async"), {}),
+                                 (api.append_all, ("local/async", [{}]), {'processes': 2}),
+                                 (api.query_many, (["count(//nonexistent)"],), {}),
+                                 (api.query_many_iter, (["count(//nonexistent)"],), {})):
+            try:
+                method(*args, **kw)
+                assert False, "expected %s to be rejected" % method.__name__
+            except PrecogClientError:
+                pass
+
+    def test_async_lost_response_is_not_resent(self):
+        s = self.server
+        api = AsyncPrecog(s.apikey, s.accountid, host=s.host, port=s.port, https=False)
+        api.delete("local/async-lost").result(10)
+        s.drop = 1
+        try:
+            api.append("local/async-lost", {"i": 1}).result(10)
+            assert False, "expected the lost response to raise"
+        except (socket.error, HTTPException):
+            pass
+        assert s.events("/%s/local/async-lost" % s.accountid) == [{"i": 1}]
+
+    def test_wait_until_visible(self):
+        server = FakePrecog(visibility_delay=0.3).start()
+        try:
+            api = Precog(server.apikey, server.accountid, host=server.host, port=server.port,
+                         https=False)
+            paths = ["local/visible%d" % i for i in range(10)]
+            for i, path in enumerate(paths):
+                api.append_all(path, [{"i": j} for j in range(i + 1)])
+            assert api.query("count(//local/visible0)") == [0]
+            queries = server.queries
+            outcomes = ThreadPool(10).map(lambda (i, p): api.wait_until_visible(p, i + 1, 5),
+                                          enumerate(paths))
+            assert outcomes == [True] * 10
+            # the waits were checked together, not one query per path per check
+            assert server.queries - queries < 20, server.queries - queries
+            assert not api.wait_until_visible("local/visible0", 2, timeout=0.2)
+            # a count above the expected one only matches when asked for
+            assert not api.wait_until_visible("local/visible9", 5, timeout=0.2)
+            assert api.wait_until_visible("local/visible9", 5, timeout=1, at_least=True)
+            api.delete("local/visible9")
+            assert api.wait_until_visible("local/visible9", 0, timeout=5)
+        finally:
+            server.stop()
+
+    def test_batching(self):
+        self.api.delete("local/batch")
+        with BatchingIngester(self.api, max_events=10) as batcher:
+            for i in range(35):
+                batcher.add("local/batch", {"i": i})
+        assert batcher.events == 35
+        assert self.api.query("count(//local/batch)") == [35]
+
+    def test_batching_async_client(self):
+        s = self.server
+        api = AsyncPrecog(s.apikey, s.accountid, host=s.host, port=s.port, https=False)
+        bad = "/%s/local/batch/bad" % s.accountid
+        s.reject.add(bad)
+        receipts = []
+        try:
+            api.delete("local/batch/async").result(10)
+            with BatchingIngester(api, max_events=10,
+                                  callback=lambda d, r, e: receipts.append((r, e))) as batcher:
+                for i in range(35):
+                    batcher.add("local/batch/async", {"i": i})
+                batcher.add("local/batch/bad", {"i": 0})
+        finally:
+            s.reject.discard(bad)
+        assert batcher.events == 35 and batcher.failures == 1
+        assert all(isinstance(r, dict) for r, e in receipts if e is None), receipts
+        assert len(s.events("/%s/local/batch/async" % s.accountid)) == 35
+
+    def test_streaming_ingest(self):
+        self.api.delete("local/streaming")
+        with StreamingIngester(self.api, max_in_flight=4) as ingester:
+            futures = [ingester.append("local/streaming", {"i": i}) for i in range(50)]
+            futures.append(ingester.append_all("local/streaming", [{"i": i} for i in range(50)]))
+        assert [f.result() for f in futures] == [None] * 51
+        assert ingester.requests == 51
+        assert self.api.query("count(//local/streaming)") == [100]
+        with StreamingIngester(self.api, receipts=True) as ingester:
+            future = ingester.append_all("local/streaming", ({"i": i} for i in range(10)))
+            bad = ingester.append_all_from_string("local/streaming", Format.json, "[")
+        assert future.result()['ingested'] == 10
+        assert isinstance(bad.exception(), PrecogServiceError)
+
+    def test_host_pool(self):
+        s = self.server
+        other = FakePrecog().start()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead = sock.getsockname()[1]
+        sock.close()
+        try:
+            hosts = HostPool([(s.host, s.port, False), (other.host, other.port, False),
+                              ('127.0.0.1', dead, False)], max_failures=1, eject_time=0.2)
+            api = Precog(s.apikey, s.accountid, hosts=hosts)
+            for i in range(20):
+                assert api.query("count(//nonexistent)") == [0]
+            stats = dict((e['port'], e) for e in hosts.stats())
+            assert stats[dead]['ejected'] and stats[dead]['errors'] == 1, stats
+            assert stats[s.port]['requests'] > 0 and stats[other.port]['requests'] > 0, stats
+            # once the ejection is over, a successful trial readmits the endpoint
+            revived = FakePrecog(port=dead).start()
+            try:
+                time.sleep(0.3)
+                api.query("count(//nonexistent)")
+                assert not any(e['ejected'] for e in hosts.stats()), hosts.stats()
+            finally:
+                revived.stop()
+        finally:
+            other.stop()
+
+    def test_adaptive_limiter(self):
+        server = FakePrecog(latency=0.01, max_concurrent=4).start()
+        try:
+            limiter = AdaptiveLimiter(initial=2)
+            api = Precog(server.apikey, server.accountid, host=server.host, port=server.port,
+                         https=False, limiter=limiter)
+            outcomes = api.query_many(["count(//nonexistent)"] * 200, concurrency=16)
+            stats = limiter.stats()['analytics']
+            assert stats['increases'] > 0 and stats['decreases'] > 0, stats
+            assert stats['in_flight'] == 0 and stats['requests'] == 200, stats
+            assert sum(1 for o in outcomes if o.error) < 100
+        finally:
+            server.stop()
+        limiter = AdaptiveLimiter(rate={'analytics': 20}, burst=1)
+        api = self.client(limiter=limiter)
+        t0 = time.time()
+        for i in range(6):
+            api.query("count(//nonexistent)")
+        assert time.time() - t0 >= 0.24
+        assert limiter.stats()['analytics']['throttled'] >= 5
+        # streamed queries hold their slot until the body has been read, and
+        # query jobs are limited too
+        limiter = AdaptiveLimiter()
+        api = self.client(limiter=limiter)
+        results = api.query_iter("count(//nonexistent)")
+        assert limiter.stats()['analytics']['in_flight'] == 1
+        assert list(results) == [0]
+        assert api.async_query("count(//nonexistent)").result(timeout=10) == [0]
+        stats = limiter.stats()['analytics']
+        assert stats['in_flight'] == 0 and stats['requests'] >= 3, stats
+
+    def test_spool(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.api.delete("local/spool")
+            with Spool(self.api, directory, segment_bytes=4096) as spool:
+                for i in range(1000):
+                    spool.add("local/spool", {"i": i})
+                spool.add_all("local/spool", [{"i": i} for i in range(1000, 1500)])
+            assert spool.stats()['pending_segments'] == 0, spool.stats()
+            assert spool.events == 1500
+            assert os.listdir(directory) == []
+            assert self.api.query("count(//local/spool)") == [1500]
+        finally:
+            shutil.rmtree(directory)
+
+    def test_spool_recovery(self):
+        directory = tempfile.mkdtemp()
+        try:
+            # a server which refuses connections
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+            sock.close()
+            s = self.server
+            down = Precog(s.apikey, s.accountid, host='127.0.0.1', port=port, https=False)
+            spool = Spool(down, directory, retry_delay=0.01)
+            spool.add_all("local/recover", [{"i": i} for i in range(10)])
+            assert not spool.flush(timeout=0.2)
+            spool.close(timeout=0)
+            assert spool.failures > 0
+            # a crashed writer leaves an open segment with a partial event
+            name = "%020d-%s.open" % (99, urlsafe_b64encode("local/recover"))
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write('{"i": 10}\n{"i": 1')
+            self.api.delete("local/recover")
+            with Spool(self.api, directory) as spool:
+                assert spool.flush(timeout=10)
+            assert os.listdir(directory) == []
+            assert self.api.query("count(//local/recover)") == [11]
+        finally:
+            shutil.rmtree(directory)
+
+    def test_spool_async_client(self):
+        directory = tempfile.mkdtemp()
+        s = self.server
+        api = AsyncPrecog(s.apikey, s.accountid, host=s.host, port=s.port, https=False)
+        try:
+            api.delete("local/spool/async").result(10)
+            with Spool(api, directory, segment_bytes=1024) as spool:
+                spool.add_all("local/spool/async", [{"i": i} for i in range(200)])
+                assert spool.flush(timeout=10)
+            assert spool.events == 200 and spool.failures == 0
+            assert len(s.events("/%s/local/spool/async" % s.accountid)) == 200
+        finally:
+            shutil.rmtree(directory)
+
+    def test_spool_rejected(self):
+        directory = tempfile.mkdtemp()
+        bad = "/%s/local/spool/bad" % self.server.accountid
+        self.server.reject.add(bad)
+        try:
+            self.api.delete("local/spool/good")
+            # retrying forever must not hold up the segments behind a rejected one
+            with Spool(self.api, directory, retry_delay=10) as spool:
+                spool.add("local/spool/bad", {"i": 0})
+                assert not spool.flush(timeout=10)
+                spool.add("local/spool/good", {"i": 1})
+                assert spool.flush(timeout=10)
+                assert spool.stats()['pending_segments'] == 0
+            assert [n.endswith('.failed') for n in os.listdir(directory)] == [True]
+            assert self.server.events("/%s/local/spool/good" % self.server.accountid) == [{"i": 1}]
+        finally:
+            self.server.reject.discard(bad)
+            shutil.rmtree(directory)
+
+    def test_hedge(self):
+        server = FakePrecog().start()
+        try:
+            policy = HedgePolicy(delay=0.05, budget=0.25)
+            api = Precog(server.apikey, server.accountid, host=server.host, port=server.port,
+                         https=False, pool=ConnectionPool(), hedge=policy)
+            api.query("count(//nonexistent)")
+            # every other request is slow, unless a hedge answers it first
+            server.slow = (2, 0.3)
+            for i in range(19):
+                assert api.query("count(//nonexistent)") == [0]
+            stats = policy.stats()
+            assert stats['requests'] == 20 and stats['delay'] == 0.05, stats
+            assert 1 <= stats['won'] <= stats['fired'] <= 5, stats
+            # each hedge opened a connection, and the aborted losers were closed, not pooled
+            api.pool.evict()
+            pool = api.pool.stats()
+            assert pool['misses'] == 1 + stats['fired'] and pool['idle'] == 1, pool
+            assert pool['evictions'] == 0, pool
+        finally:
+            server.stop()
+        policy = HedgePolicy(percentile=50, min_samples=4)
+        assert policy.stats()['delay'] is None
+        for latency in (0.1, 0.2, 0.3, 0.4):
+            policy.finish(latency, False)
+        assert policy.stats()['delay'] == 0.3
+
+    def test_metrics(self):
+        metrics = MetricsRegistry()
+        api = self.client(metrics=metrics)
+        api.query("count(//nonexistent)")
+        snapshot = metrics.snapshot()
+        assert snapshot['analytics']['requests'] == 1, snapshot
+        assert snapshot['analytics']['status'] == {200: 1}, snapshot
+        assert 'ttfb' in snapshot['analytics']['latency'], snapshot
+
+    def test_metrics_everywhere(self):
+        metrics = MetricsRegistry()
+        samples = []
+        metrics.add_listener(samples.append)
+        s = self.server
+        # hedged, streamed and query job requests record their samples too
+        api = self.client(metrics=metrics, hedge=HedgePolicy(delay=10))
+        assert api.query("count(//nonexistent)") == [0]
+        assert list(api.query_iter("count(//nonexistent)")) == [0]
+        job = api.async_query("count(//nonexistent)")
+        assert job.result(timeout=10) == [0]
+        api.async_results(job.jobid)
+        aapi = AsyncPrecog(s.apikey, s.accountid, host=s.host, port=s.port, https=False,
+                           metrics=metrics)
+        assert aapi.query("count(//nonexistent)").result(10) == [0]
+        gets = [x for x in samples if x['method'] == 'GET']
+        assert len(gets) >= 4, samples
+        for sample in gets:
+            assert sample['status'] in (200, 202) and sample['bytes_received'] > 0, sample
+            for phase in ('send', 'ttfb', 'read', 'total'):
+                assert phase in sample['phases'], sample